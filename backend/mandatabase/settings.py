@@ -129,7 +129,7 @@ CORS_ALLOW_CREDENTIALS = True
 #     'localhost:63343',
 # ]
 
-CORS_ALLOW_METHODS = ["GET"]
+CORS_ALLOW_METHODS = ["GET", "POST"]
 
 CORS_ALLOW_HEADERS = [
     'Content-Type',
@@ -156,6 +156,11 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "mandatabase.wsgi.application"
 
+# Serve list_sites, site_measurements and display_info from the async views in
+# maritimeapp/async_views.py; only useful when running under ASGI (mandatabase.asgi).
+# Needs Django 5.0+, whose view decorators (require_GET, condition, ...) accept async views
+ASYNC_VIEWS = config.getboolean("server", "ASYNC_VIEWS", fallback=False)
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
@@ -170,6 +175,50 @@ DATABASES = {
     }
 }
 
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# "queries" holds serialized API responses (see maritimeapp/cache.py). LocMemCache
+# evicts least recently used entries past MAX_ENTRIES; point [cache] BACKEND in
+# config.ini at FileBasedCache (LOCATION = a directory) to share it between workers.
+# With LocMemCache each web process can hold up to MAX_ENTRIES * MAX_ENTRY_BYTES of
+# responses: 256 MiB with the defaults below. Raise them together with care.
+QUERY_CACHE_ALIAS = "queries"
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    QUERY_CACHE_ALIAS: {
+        "BACKEND": config.get(
+            "cache", "BACKEND", fallback="django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": config.get("cache", "LOCATION", fallback="maritime-queries"),
+        "TIMEOUT": None,
+        "OPTIONS": {
+            "MAX_ENTRIES": config.getint("cache", "MAX_ENTRIES", fallback=256),
+            "CULL_FREQUENCY": 4,
+        },
+    },
+}
+
+# Responses larger than this are not cached
+QUERY_CACHE_MAX_ENTRY_BYTES = config.getint(
+    "cache", "MAX_ENTRY_BYTES", fallback=1024 * 1024
+)
+
+# Cache-Control max-age for the read endpoints; clients revalidate with the ETag after it
+QUERY_CACHE_MAX_AGE = config.getint("cache", "MAX_AGE", fallback=300)
+
+# Generated download archives (maritimeapp/archive_cache.py), evicted least
+# recently used first once the directory exceeds ARCHIVE_MAX_BYTES
+ARCHIVE_CACHE_DIR = config.get("cache", "ARCHIVE_DIR", fallback="./archive_cache")
+ARCHIVE_CACHE_MAX_BYTES = config.getint(
+    "cache", "ARCHIVE_MAX_BYTES", fallback=10 * 1024 * 1024 * 1024
+)
+
+# Concurrent archive builds per web process for download jobs (maritimeapp/jobs.py)
+DOWNLOAD_JOB_WORKERS = config.getint("downloads", "JOB_WORKERS", fallback=2)
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 AUTH_PASSWORD_VALIDATORS = [
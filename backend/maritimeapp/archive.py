@@ -0,0 +1,299 @@
+"""
+Streaming tar.gz archives for download_data.
+
+The source files matching a download selection are read from ./src and
+written as tar entries straight into a gzip stream, which is handed to the
+response as it is produced. Nothing is staged on disk: unfiltered files are
+copied block by block, date-only filters are served from the byte ranges
+in the file's date index (date_index.py) when it is current, and other
+filtered copies are built in a spooled temporary file (in memory up to
+SPOOL_BYTES) one file at a time. Filtering is done per line on the raw
+bytes (line_filter.py), so kept lines are identical to the source.
+"""
+
+import gzip
+import os
+import tarfile
+import tempfile
+from datetime import datetime
+
+from .date_index import SegmentReader, date_segments, load_index, month_ranges
+from .ingest import HEADER_LINES
+from .line_filter import line_filter
+from .streams import ChunkSink
+
+SRC_DIR = "./src"
+
+# Copied into the root of every archive
+POLICY_FILES = ["data_usage_policy.pdf", "data_usage_policy.txt"]
+
+FILE_ENDINGS = [
+    "all_points.lev10",
+    "all_points.lev15",
+    "all_points.lev20",
+    "series.lev15",
+    "series.lev20",
+    "daily.lev15",
+    "daily.lev20",
+    "all_points.ONEILL_10",
+    "all_points.ONEILL_15",
+    "all_points.ONEILL_20",
+    "series.ONEILL_15",
+    "series.ONEILL_20",
+    "daily.ONEILL_15",
+    "daily.ONEILL_20",
+]
+
+QUALITY_MAP = {
+    "AOD": {
+        "Level 1.0": "lev10",
+        "Level 1.5": "lev15",
+        "Level 2.0": "lev20",
+    },
+    "SDA": {
+        "Level 1.0": "ONEILL_10",
+        "Level 1.5": "ONEILL_15",
+        "Level 2.0": "ONEILL_20",
+    },
+}
+
+FREQUENCY_PREFIXES = {
+    "Series": "series",
+    "Point": "all_points",
+    "Daily": "daily",
+}
+
+# First date offered by the frontend; a start_date equal to it is not a filter
+INIT_START_DATE = "2004-10-16"
+
+READ_BLOCK_BYTES = 1024 * 1024
+
+# Filtered copies larger than this spill from memory to a temporary file
+SPOOL_BYTES = 16 * 1024 * 1024
+
+# Matching lines are written out in batches of this many
+FILTER_BATCH_LINES = 5000
+
+COMPRESS_LEVEL = 6
+
+
+def download_selection(params):
+    """
+    The files and filters asked for by a download_data request. Dates equal
+    to the frontend's defaults (first date, today) are dropped.
+    """
+    start_date = params.get("start_date") or None
+    end_date = params.get("end_date") or None
+    if start_date == INIT_START_DATE:
+        start_date = None
+    if end_date == datetime.now().date().strftime("%Y-%m-%d"):
+        end_date = None
+
+    return {
+        "sites": params.getlist("sites[]"),
+        "retrievals": params.getlist("retrievals[]"),
+        "frequency": params.getlist("frequency[]"),
+        "quality": params.getlist("quality[]"),
+        "start_date": start_date,
+        "end_date": end_date,
+        "bounds": {
+            key: params.get(key) or None
+            for key in ("min_lat", "min_lng", "max_lat", "max_lng")
+        },
+    }
+
+
+def needs_filter(selection):
+    return bool(
+        selection["start_date"]
+        or selection["end_date"]
+        or any(selection["bounds"].values())
+    )
+
+
+def archive_folder(key):
+    # Derived from the archive key rather than the clock, so rebuilding the
+    # same archive gives the same bytes (and the cached ETag stays valid)
+    return f"{key[:12]}_MAN_DATA"
+
+
+def selected_files(selection, src_dir=SRC_DIR):
+    """
+    (retrieval, file name, path) of every source file under src_dir that
+    matches the selection.
+    """
+    for retrieval in selection["retrievals"]:
+        # TODO: Log to log file
+        if retrieval not in QUALITY_MAP:
+            print(f"Warning: Retrieval '{retrieval}' not in quality map")
+            continue
+
+        for site in selection["sites"]:
+            for freq in selection["frequency"]:
+                prefix = FREQUENCY_PREFIXES.get(freq)
+                if prefix is None:
+                    continue
+                for q in selection["quality"]:
+                    file_ending = QUALITY_MAP[retrieval].get(q)
+                    if not file_ending or f"{prefix}.{file_ending}" not in FILE_ENDINGS:
+                        continue
+                    file_name = f"{site}_{prefix}.{file_ending}"
+                    path = os.path.join(src_dir, retrieval, file_name)
+                    if os.path.isfile(path):
+                        yield retrieval, file_name, path
+
+
+def filter_file(file_path, start_date, end_date, bounds, out, index=None):
+    """
+    Write the header block of file_path and its data lines within the date
+    range and bounds to the binary file out, byte for byte. With a current
+    date index only the months in range are read. Returns False when no line
+    matches.
+    """
+    with open(file_path, "rb") as f:
+        header = b"".join(f.readline() for _ in range(HEADER_LINES))
+        keep = line_filter(header.splitlines()[-1], start_date, end_date, bounds)
+        out.write(header)
+
+        if index is None:
+            ranges = [(len(header), None)]
+        else:
+            ranges = [
+                (start, end) for start, end, _ in month_ranges(index, start_date, end_date)
+            ]
+
+        matched = False
+        for start, end in ranges:
+            f.seek(start)
+            remaining = end - start if end is not None else None
+            kept = []
+            for line in f:
+                if keep(line):
+                    kept.append(line)
+                if len(kept) >= FILTER_BATCH_LINES:
+                    out.write(b"".join(kept))
+                    matched, kept = True, []
+                if remaining is not None:
+                    remaining -= len(line)
+                    if remaining <= 0:
+                        break
+            if kept:
+                out.write(b"".join(kept))
+                matched = True
+    return matched
+
+
+def _column_header(path):
+    with open(path, "rb") as f:
+        return [f.readline() for _ in range(HEADER_LINES)][-1]
+
+
+def _write_entry(gz, sink, arcname, source, size, mtime):
+    # Tar header, exactly size bytes of source, then padding to the block size
+    info = tarfile.TarInfo(arcname)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    gz.write(info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape"))
+
+    remaining = size
+    while remaining:
+        block = source.read(min(READ_BLOCK_BYTES, remaining))
+        if not block:
+            # Source shrank while being read; keep the entry at its declared size
+            block = b"\0" * remaining
+        gz.write(block)
+        remaining -= len(block)
+        data = sink.drain()
+        if data:
+            yield data
+
+    gz.write(b"\0" * (-size % tarfile.BLOCKSIZE))
+
+
+def archive_stream(selection, folder, src_dir=SRC_DIR, progress=None):
+    """
+    Yield a tar.gz of the policy files and the selected source files (filtered
+    by date and bounds when the selection asks for it) under folder/.
+
+    progress, if given, is called with the number of source files handled so
+    far after each one.
+    """
+    sink = ChunkSink()
+    # mtime=0 keeps the build time out of the gzip header
+    gz = gzip.GzipFile(fileobj=sink, mode="wb", compresslevel=COMPRESS_LEVEL, mtime=0)
+    # The gzip header is written up front, so the response starts immediately
+    yield sink.drain()
+
+    for policy_file in POLICY_FILES:
+        path = os.path.join(src_dir, policy_file)
+        if not os.path.isfile(path):
+            # TODO: Log to log file
+            print(f"Source policy file {path} does not exist")
+            continue
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            yield from _write_entry(
+                gz, sink, f"{folder}/{policy_file}", f, stat.st_size, stat.st_mtime
+            )
+
+    filtering = needs_filter(selection)
+    for handled, (retrieval, file_name, path) in enumerate(
+        selected_files(selection, src_dir), 1
+    ):
+        arcname = f"{folder}/{retrieval}/{file_name}"
+        mtime = os.path.getmtime(path)
+
+        index = None
+        if filtering and (selection["start_date"] or selection["end_date"]):
+            index = load_index(path)
+
+        if not filtering:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                yield from _write_entry(gz, sink, arcname, f, size, mtime)
+        elif index is not None and not any(selection["bounds"].values()):
+            # Date-only filter: raw byte ranges from the date index, so the entry
+            # size is known without spooling the filtered copy
+            try:
+                keep = line_filter(
+                    _column_header(path), selection["start_date"], selection["end_date"]
+                )
+                segments = date_segments(
+                    path, index, selection["start_date"], selection["end_date"], keep
+                )
+            # TODO: Log exceptions to log file
+            except Exception as e:
+                print(f"Error processing file {path}: {e}")
+                segments = None
+            if segments:
+                with SegmentReader(path, segments) as reader:
+                    yield from _write_entry(gz, sink, arcname, reader, reader.size, mtime)
+        else:
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as spool:
+                try:
+                    matched = filter_file(
+                        path,
+                        selection["start_date"],
+                        selection["end_date"],
+                        selection["bounds"],
+                        spool,
+                        index,
+                    )
+                # TODO: Log exceptions to log file
+                except Exception as e:
+                    print(f"Error processing file {path}: {e}")
+                    matched = False
+                if matched:
+                    size = spool.tell()
+                    spool.seek(0)
+                    yield from _write_entry(gz, sink, arcname, spool, size, mtime)
+
+        if progress:
+            progress(handled)
+
+    # End-of-archive marker, padded to a whole tar record like tarfile does
+    gz.write(b"\0" * (tarfile.BLOCKSIZE * 2))
+    gz.write(b"\0" * (-gz.tell() % tarfile.RECORDSIZE))
+    gz.close()
+    yield sink.drain()
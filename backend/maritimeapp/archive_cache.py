@@ -0,0 +1,195 @@
+"""
+On-disk cache of generated download archives.
+
+Archives are stored under settings.ARCHIVE_CACHE_DIR, named by a sha256 of
+the normalized download selection and the size/mtime of every source file
+that goes into it, so a populate run that changes a file also changes the key
+of every archive built from it. The directory is kept under
+ARCHIVE_CACHE_MAX_BYTES by removing the least recently used archives.
+Building an archive is deterministic for its key, so the key doubles as the
+ETag of both the streamed and the stored copy.
+
+Hits are served with FileResponse (sendfile where the server supports it),
+and single-range Range requests get a 206 so interrupted downloads can resume.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+
+from .archive import POLICY_FILES, READ_BLOCK_BYTES, SRC_DIR, selected_files
+
+ARCHIVE_CACHE_DIR = getattr(settings, "ARCHIVE_CACHE_DIR", "./archive_cache")
+ARCHIVE_CACHE_MAX_BYTES = getattr(settings, "ARCHIVE_CACHE_MAX_BYTES", 10 * 1024**3)
+
+# Bump when the archive layout or filtering changes so old entries are no longer served
+ARCHIVE_FORMAT = 3
+
+# Unfinished writes older than this are left over from a crashed worker
+STALE_PART_SECONDS = 24 * 60 * 60
+
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def _number(value):
+    try:
+        return repr(float(value))
+    except (TypeError, ValueError):
+        return value
+
+
+def archive_key(selection, src_dir=SRC_DIR):
+    normalized = {
+        "sites": sorted(set(selection["sites"])),
+        "retrievals": sorted(set(selection["retrievals"])),
+        "frequency": sorted(set(selection["frequency"])),
+        "quality": sorted(set(selection["quality"])),
+        "start_date": selection["start_date"],
+        "end_date": selection["end_date"],
+        "bounds": {key: _number(value) for key, value in selection["bounds"].items()},
+    }
+
+    paths = [os.path.join(src_dir, policy_file) for policy_file in POLICY_FILES]
+    paths += sorted(path for _, _, path in selected_files(selection, src_dir))
+    sources = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        sources.append((path, stat.st_size, stat.st_mtime_ns))
+
+    raw = json.dumps(
+        {"format": ARCHIVE_FORMAT, "selection": normalized, "sources": sources},
+        sort_keys=True,
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def cached_archive(key):
+    """Path of the stored archive for key, or None."""
+    matches = glob.glob(os.path.join(ARCHIVE_CACHE_DIR, f"{key}.*.tar.gz"))
+    if not matches:
+        return None
+    # Mark as recently used; atime alone is unreliable on noatime mounts
+    try:
+        os.utime(matches[0])
+    except FileNotFoundError:
+        return None
+    return matches[0]
+
+
+def archive_filename(path):
+    # <key>.<folder>.tar.gz -> <folder>.tar.gz
+    return os.path.basename(path).split(".", 1)[1]
+
+
+def evict():
+    """Remove least recently used archives until the cache fits its size cap."""
+    entries = []
+    for path in glob.glob(os.path.join(ARCHIVE_CACHE_DIR, "*")):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if path.endswith(".part"):
+            if time.time() - stat.st_mtime > STALE_PART_SECONDS:
+                os.remove(path)
+            continue
+        entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= ARCHIVE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def store_archive(chunks, key, folder):
+    """
+    Pass chunks through unchanged while writing them to the cache. The entry
+    only becomes visible once the archive is complete; a client disconnect
+    discards the partial file. Archives are deterministic for a key, so
+    concurrent builds of the same key replace one another in place.
+    """
+    os.makedirs(ARCHIVE_CACHE_DIR, exist_ok=True)
+    fd, part_path = tempfile.mkstemp(dir=ARCHIVE_CACHE_DIR, suffix=".part")
+    stored = False
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(part_path, os.path.join(ARCHIVE_CACHE_DIR, f"{key}.{folder}.tar.gz"))
+        stored = True
+        evict()
+    finally:
+        if not stored and os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def _read_range(f, length):
+    with f:
+        while length > 0:
+            block = f.read(min(READ_BLOCK_BYTES, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+def archive_response(request, path, key):
+    """
+    Serve a stored archive, honouring a single Range (and If-Range) header.
+    """
+    size = os.path.getsize(path)
+    etag = f'"{key}"'
+    match = RANGE_RE.fullmatch(request.headers.get("Range", "").strip())
+    if_range = request.headers.get("If-Range")
+
+    if match and (if_range is None or if_range == etag) and any(match.groups()):
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            # bytes=-N is the last N bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+
+        if start >= size or start > end:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            response["Accept-Ranges"] = "bytes"
+            return response
+
+        f = open(path, "rb")
+        f.seek(start)
+        response = StreamingHttpResponse(
+            _read_range(f, end - start + 1), status=206, content_type="application/gzip"
+        )
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = end - start + 1
+        response["Content-Disposition"] = f'attachment; filename="{archive_filename(path)}"'
+    else:
+        response = FileResponse(
+            open(path, "rb"),
+            as_attachment=True,
+            filename=archive_filename(path),
+            content_type="application/gzip",
+        )
+
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    return response
@@ -0,0 +1,181 @@
+"""
+Native async versions of the read endpoints for ASGI deployments.
+
+list_sites, site_measurements and get_display_info take the same parameters
+and return the same payloads as their counterparts in views.py, but run
+their queries through Django's async ORM (aexists, aiterator, async
+iteration) and stream from async generators, so a request waiting on a slow
+PostGIS query does not hold a worker thread. urls.py routes to these when
+[server] ASYNC_VIEWS is enabled in config.ini.
+"""
+
+import json
+
+from django.contrib.gis.geos import Polygon
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+
+from .cache import adataset_version, cached_query, conditional_query
+from .models import ReadingStatistic, Site, SiteExtent, SiteMeasurementsDaily15
+from .streams import ChunkSink
+from .views import (
+    COLUMNAR_BATCH_SIZE,
+    STREAM_CHUNK_SIZE,
+    _display_info,
+    columnar_response,
+    columnar_writer,
+    filter_site_dates,
+    measurement_plan,
+    page_response,
+    record_batch,
+    refresh_display_info,
+)
+
+
+async def json_array_stream(items):
+    # Async counterpart of views.json_array_stream
+    yield "["
+    separator = ""
+    buffer = []
+    async for item in items:
+        buffer.append(separator + json.dumps(item, cls=DjangoJSONEncoder))
+        separator = ","
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            yield "".join(buffer)
+            buffer = []
+    buffer.append("]")
+    yield "".join(buffer)
+
+
+async def sites_in_bbox(bbox):
+    # Same two-step lookup as views.sites_in_bbox
+    outer, inner = SiteExtent.search_boxes(bbox)
+    candidates = SiteExtent.objects.filter(extent__intersects=outer)
+    inside = set()
+    if inner is not None:
+        inside = {
+            site_id
+            async for site_id in candidates.filter(extent__coveredby=inner).values_list(
+                "site_id", flat=True
+            )
+        }
+    borderline = [
+        site_id
+        async for site_id in candidates.exclude(site_id__in=inside).values_list(
+            "site_id", flat=True
+        )
+    ]
+    if borderline:
+        async for site_id in (
+            SiteMeasurementsDaily15.objects.filter(
+                site_id__in=borderline, latlng__within=bbox
+            )
+            .values_list("site_id", flat=True)
+            .distinct()
+        ):
+            inside.add(site_id)
+    return inside
+
+
+@require_GET
+@conditional_query
+@cached_query
+async def list_sites(request):
+    min_lat = request.GET.get("min_lat")
+    min_lng = request.GET.get("min_lng")
+    max_lat = request.GET.get("max_lat")
+    max_lng = request.GET.get("max_lng")
+
+    queryset = Site.objects.all()
+
+    if min_lat and min_lng and max_lat and max_lng:
+        try:
+            bbox_polygon = Polygon.from_bbox(
+                (float(min_lng), float(min_lat), float(max_lng), float(max_lat))
+            )
+        except (ValueError, TypeError) as e:
+            print(f"Error with bounding box coordinates: {e}")
+            return JsonResponse([], safe=False)
+
+        if await SiteExtent.objects.aexists():
+            filtered_sites_ids = await sites_in_bbox(bbox_polygon)
+        else:
+            filtered_sites_ids = {
+                site_id
+                async for site_id in SiteMeasurementsDaily15.objects.filter(
+                    latlng__within=bbox_polygon
+                )
+                .values_list("site_id", flat=True)
+                .distinct()
+            }
+
+        if not filtered_sites_ids:
+            return JsonResponse([], safe=False)
+        queryset = queryset.filter(name__in=filtered_sites_ids)
+
+    queryset = filter_site_dates(queryset, request.GET)
+    queryset = queryset.annotate(start_date=F("span_date__0")).order_by("start_date")
+
+    sites = [site async for site in queryset.values("name", "span_date")]
+    return JsonResponse(sites, safe=False)
+
+
+async def load_display_info():
+    version, _ = await adataset_version()
+    if _display_info["version"] != version:
+        statistics = [statistic async for statistic in ReadingStatistic.objects.all()]
+        refresh_display_info(version, statistics)
+    return _display_info
+
+
+@require_GET
+@conditional_query
+async def get_display_info(request):
+    info = await load_display_info()
+    site = request.GET.get("site", "")
+    return JsonResponse({"opts": info["opts"], "stats": info["stats"].get(site, {})})
+
+
+async def columnar_stream(rows, output_format):
+    sink = ChunkSink()
+    writer = columnar_writer(sink, output_format)
+
+    chunk = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) >= COLUMNAR_BATCH_SIZE:
+            writer.write_batch(record_batch(chunk))
+            chunk = []
+            yield sink.drain()
+    if chunk:
+        writer.write_batch(record_batch(chunk))
+    writer.close()
+    yield sink.drain()
+
+
+@require_GET
+@conditional_query
+@cached_query
+async def site_measurements(request):
+    # Same parameters and validation as views.site_measurements (measurement_plan);
+    # only running the rows differs
+    plan = measurement_plan(request.GET)
+    if isinstance(plan, JsonResponse):
+        return plan
+
+    rows = plan["rows"]
+    if plan["format"]:
+        rows = rows.aiterator(chunk_size=STREAM_CHUNK_SIZE)
+        return columnar_response(columnar_stream(rows, plan["format"]), plan["format"])
+    if plan["limit"]:
+        return page_response([row async for row in rows], plan["limit"])
+    if plan["stream"]:
+        items = (
+            plan["item"](row) async for row in rows.aiterator(chunk_size=STREAM_CHUNK_SIZE)
+        )
+        return StreamingHttpResponse(
+            json_array_stream(items), content_type="application/json"
+        )
+    return JsonResponse([plan["item"](row) async for row in rows], safe=False)
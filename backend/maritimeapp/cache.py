@@ -0,0 +1,197 @@
+"""
+Query-result cache for the read endpoints.
+
+Responses are stored as serialized bytes in the cache named by
+settings.QUERY_CACHE_ALIAS, keyed on the view and its normalized query
+parameters. Each entry records the DatasetVersion it was built from, and a
+hit from an older version is treated as a miss, so populate and
+update_dates invalidate everything by bumping the version.
+
+The same version and normalized query give the strong ETag used for
+conditional GETs.
+
+Both decorators also accept coroutine views (see async_views.py); the
+dataset version is then read with the async ORM before the view runs.
+"""
+
+import hashlib
+import math
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+
+from .models import DatasetVersion
+
+QUERY_CACHE_ALIAS = getattr(settings, "QUERY_CACHE_ALIAS", "default")
+
+# Bounding boxes are snapped outward to this grid (degrees) before querying, so
+# small map pans share cache entries
+BBOX_GRID = getattr(settings, "QUERY_CACHE_BBOX_GRID", 0.01)
+
+# Responses larger than this are served but not cached
+MAX_ENTRY_BYTES = getattr(settings, "QUERY_CACHE_MAX_ENTRY_BYTES", 1024 * 1024)
+
+# Cache-Control max-age (seconds) for browsers and proxies; after that they
+# revalidate with If-None-Match / If-Modified-Since
+MAX_AGE = getattr(settings, "QUERY_CACHE_MAX_AGE", 300)
+
+# How long a process trusts its last read of the dataset version
+VERSION_TTL = getattr(settings, "QUERY_CACHE_VERSION_TTL", 5)
+
+_version_state = {"checked": 0.0, "version": None}
+
+
+def _version_stale(now):
+    return _version_state["version"] is None or now - _version_state["checked"] > VERSION_TTL
+
+
+def _remember_version(current, now):
+    _version_state["version"] = (current.version, current.updated_at)
+    _version_state["checked"] = now
+    return _version_state["version"]
+
+
+def dataset_version():
+    now = time.monotonic()
+    if _version_stale(now):
+        return _remember_version(DatasetVersion.current(), now)
+    return _version_state["version"]
+
+
+async def adataset_version():
+    now = time.monotonic()
+    if _version_stale(now):
+        current, _ = await DatasetVersion.objects.aget_or_create(pk=1)
+        return _remember_version(current, now)
+    return _version_state["version"]
+
+
+def _request_version(request):
+    # Async views fetch the version up front so the sync ETag/Last-Modified
+    # callbacks never query the database from the event loop
+    return getattr(request, "dataset_version", None) or dataset_version()
+
+
+def normalize_params(params):
+    """
+    Copy of a request's QueryDict with sites sorted and de-duplicated and the
+    bounding box snapped outward to BBOX_GRID.
+    """
+    normalized = params.copy()
+
+    if normalized.get("sites"):
+        sites = sorted(set(filter(None, normalized["sites"].split(","))))
+        normalized["sites"] = ",".join(sites)
+
+    try:
+        for key, snap in (
+            ("min_lat", math.floor),
+            ("min_lng", math.floor),
+            ("max_lat", math.ceil),
+            ("max_lng", math.ceil),
+        ):
+            if normalized.get(key):
+                value = snap(float(normalized[key]) / BBOX_GRID) * BBOX_GRID
+                normalized[key] = f"{value:.6f}"
+    except ValueError:
+        # Left as-is; the view reports the bad coordinates
+        pass
+
+    return normalized
+
+
+def query_key(view_name, params, *args):
+    items = sorted((key, tuple(params.getlist(key))) for key in params)
+    raw = repr((view_name, args, items)).encode()
+    return f"query:{view_name}:{hashlib.sha256(raw).hexdigest()}"
+
+
+def cached_query(view):
+    """
+    Serve a view from the query cache while the dataset version is unchanged.
+
+    Only complete 200 responses are stored; streaming responses pass through.
+    """
+
+    def cacheable(response):
+        return (
+            response.status_code == 200
+            and not response.streaming
+            and len(response.content) <= MAX_ENTRY_BYTES
+        )
+
+    if iscoroutinefunction(view):
+
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            request.GET = normalize_params(request.GET)
+            version, _ = await adataset_version()
+            key = query_key(view.__name__, request.GET, *args, *sorted(kwargs.items()))
+            cache = caches[QUERY_CACHE_ALIAS]
+
+            entry = await cache.aget(key)
+            if entry is not None and entry[0] == version:
+                return HttpResponse(entry[2], content_type=entry[1])
+
+            response = await view(request, *args, **kwargs)
+            if cacheable(response):
+                await cache.aset(key, (version, response["Content-Type"], response.content))
+            return response
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        request.GET = normalize_params(request.GET)
+        version, _ = dataset_version()
+        key = query_key(view.__name__, request.GET, *args, *sorted(kwargs.items()))
+        cache = caches[QUERY_CACHE_ALIAS]
+
+        entry = cache.get(key)
+        if entry is not None and entry[0] == version:
+            return HttpResponse(entry[2], content_type=entry[1])
+
+        response = view(request, *args, **kwargs)
+        if cacheable(response):
+            cache.set(key, (version, response["Content-Type"], response.content))
+        return response
+
+    return wrapper
+
+
+def conditional_query(view):
+    """
+    Strong ETag and Last-Modified from the dataset version, so a matching
+    If-None-Match / If-Modified-Since gets 304 Not Modified, plus a public
+    Cache-Control header.
+    """
+
+    def etag(request, *args, **kwargs):
+        version, _ = _request_version(request)
+        key = query_key(
+            view.__name__, normalize_params(request.GET), *args, *sorted(kwargs.items())
+        )
+        return hashlib.sha256(f"{version}:{key}".encode()).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        return _request_version(request)[1]
+
+    conditional = cache_control(public=True, max_age=MAX_AGE)(
+        condition(etag_func=etag, last_modified_func=last_modified)(view)
+    )
+    if not iscoroutinefunction(view):
+        return conditional
+
+    @wraps(view)
+    async def async_wrapper(request, *args, **kwargs):
+        request.dataset_version = await adataset_version()
+        return await conditional(request, *args, **kwargs)
+
+    return async_wrapper
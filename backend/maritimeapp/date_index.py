@@ -0,0 +1,190 @@
+"""
+Byte-offset date index over the source files in ./src.
+
+For each source file populate writes a JSON sidecar (<file>.dateidx) listing
+the byte range of every run of consecutive lines from the same month,
+together with the size of the header block and the file's size and mtime.
+A date-filtered download then copies the header and the months strictly
+inside the range as raw byte ranges, and only scans the lines of the first
+and last month. An index whose size/mtime no longer match its file is
+ignored, and the caller falls back to scanning the whole file.
+"""
+
+import json
+import os
+
+from .ingest import HEADER_LINES
+from .line_filter import DATE_COLUMN, line_date
+
+INDEX_SUFFIX = ".dateidx"
+
+# Bump when the index layout changes
+INDEX_FORMAT = 1
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def build_index(path):
+    """
+    Scan path once and return its index, or None if it has no date column.
+    """
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        header = [f.readline() for _ in range(HEADER_LINES)]
+        columns = header[-1].rstrip(b"\r\n").split(b",")
+        if DATE_COLUMN not in columns:
+            return None
+        date_column = columns.index(DATE_COLUMN)
+
+        offset = sum(len(line) for line in header)
+        runs = []
+        current = None
+        for line in f:
+            fields = line.split(b",", date_column + 1)
+            day = line_date(fields[date_column]) if len(fields) > date_column else None
+            month = day[:7] if day else None
+            if current is not None and current[0] == month:
+                current[2] = offset + len(line)
+            else:
+                current = [month, offset, offset + len(line)]
+                runs.append(current)
+            offset += len(line)
+
+    return {
+        "format": INDEX_FORMAT,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "header_end": sum(len(line) for line in header),
+        "date_column": date_column,
+        "runs": runs,
+    }
+
+
+def load_index(path):
+    """The stored index of path if it is still current, else None."""
+    try:
+        with open(index_path(path)) as f:
+            index = json.load(f)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if (
+        index.get("format") != INDEX_FORMAT
+        or index.get("size") != stat.st_size
+        or index.get("mtime_ns") != stat.st_mtime_ns
+    ):
+        return None
+    return index
+
+
+def ensure_index(path):
+    """
+    Write the sidecar index of path unless a current one exists. Returns True
+    if an index was (re)built.
+    """
+    if load_index(path) is not None:
+        return False
+    index = build_index(path)
+    if index is None:
+        return False
+
+    target = index_path(path)
+    with open(target + ".tmp", "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    os.replace(target + ".tmp", target)
+    return True
+
+
+def month_ranges(index, start_date, end_date):
+    """
+    Byte ranges of the data lines whose month overlaps [start_date, end_date]
+    ("YYYY-MM-DD", either may be None), as (start, end, boundary) with
+    adjacent ranges merged. Lines in boundary ranges (the first and last
+    month) still need checking line by line; the rest are entirely in range.
+    """
+    start_month = start_date[:7] if start_date else None
+    end_month = end_date[:7] if end_date else None
+
+    ranges = []
+    for month, start, end in index["runs"]:
+        if month is None:
+            continue
+        if (start_month and month < start_month) or (end_month and month > end_month):
+            continue
+        boundary = month in (start_month, end_month)
+        if ranges and ranges[-1][1] == start and ranges[-1][2] == boundary:
+            ranges[-1] = (ranges[-1][0], end, boundary)
+        else:
+            ranges.append((start, end, boundary))
+    return ranges
+
+
+def date_segments(path, index, start_date, end_date, keep):
+    """
+    Pieces of path covering the header and the lines dated within
+    [start_date, end_date]: (start, end) byte ranges to copy as-is, and bytes
+    holding the lines of the boundary months that pass keep. Returns None
+    when no line is in range.
+    """
+    segments = [(0, index["header_end"])]
+    with open(path, "rb") as f:
+        for start, end, boundary in month_ranges(index, start_date, end_date):
+            if not boundary:
+                segments.append((start, end))
+                continue
+            f.seek(start)
+            lines = f.read(end - start).splitlines(keepends=True)
+            kept = b"".join(line for line in lines if keep(line))
+            if kept:
+                segments.append(kept)
+
+    return segments if len(segments) > 1 else None
+
+
+class SegmentReader:
+    """
+    Read-only file object over a list of date_segments() pieces of path.
+    """
+
+    def __init__(self, path, segments):
+        self.file = open(path, "rb")
+        self.segments = list(segments)
+        self.size = sum(
+            len(piece) if isinstance(piece, bytes) else piece[1] - piece[0]
+            for piece in self.segments
+        )
+        self.current = b""
+
+    def read(self, size=-1):
+        chunks = []
+        wanted = size if size >= 0 else self.size
+        while wanted > 0:
+            if not self.current:
+                if not self.segments:
+                    break
+                piece = self.segments.pop(0)
+                if isinstance(piece, bytes):
+                    self.current = piece
+                else:
+                    # Raw ranges are read lazily, one block at a time
+                    start, end = piece
+                    if end - start > wanted:
+                        self.segments.insert(0, (start + wanted, end))
+                        end = start + wanted
+                    self.file.seek(start)
+                    self.current = self.file.read(end - start)
+            data, self.current = self.current[:wanted], self.current[wanted:]
+            chunks.append(data)
+            wanted -= len(data)
+        return b"".join(chunks)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
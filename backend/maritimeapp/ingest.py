@@ -0,0 +1,309 @@
+"""
+Bulk loading of MAN daily files into the measurement tables.
+
+Files are converted column-wise into a typed record batch (transform_frame),
+and rows for a whole file (or batch) are written to a temporary staging table with
+PostgreSQL COPY and merged into SiteMeasurementsDaily15/20 with a single
+INSERT ... ON CONFLICT statement, instead of a get_or_create per row.
+
+Every loaded file is recorded in IngestManifest with its size and checksum so
+later runs can skip files that have not changed.
+"""
+
+import hashlib
+import io
+import os
+
+import numpy as np
+import pandas as pd
+from django.db import connection, transaction
+from django.db.models import Max
+
+from .models import IngestManifest, Site, SiteMeasurementsDaily15, SiteMeasurementsDaily20
+
+DAILY_HEADER = [
+    "Date(dd:mm:yyyy)",
+    "Time(hh:mm:ss)",
+    "Air Mass",
+    "Latitude",
+    "Longitude",
+    "AOD_340nm",
+    "AOD_380nm",
+    "AOD_440nm",
+    "AOD_500nm",
+    "AOD_675nm",
+    "AOD_870nm",
+    "AOD_1020nm",
+    "AOD_1640nm",
+    "Water Vapor(cm)",
+    "440-870nm_Angstrom_Exponent",
+    "STD_340nm",
+    "STD_380nm",
+    "STD_440nm",
+    "STD_500nm",
+    "STD_675nm",
+    "STD_870nm",
+    "STD_1020nm",
+    "STD_1640nm",
+    "STD_Water_Vapor(cm)",
+    "STD_440-870nm_Angstrom_Exponent",
+    "Number_of_Observations",
+    "Last_Processing_Date(dd:mm:yyyy)",
+    "AERONET_Number",
+    "Microtops_Number",
+]
+
+# Source column -> model field for the float readings
+FLOAT_COLUMNS = {
+    "Air Mass": "air_mass",
+    "AOD_340nm": "aod_340nm",
+    "AOD_380nm": "aod_380nm",
+    "AOD_440nm": "aod_440nm",
+    "AOD_500nm": "aod_500nm",
+    "AOD_675nm": "aod_675nm",
+    "AOD_870nm": "aod_870nm",
+    "AOD_1020nm": "aod_1020nm",
+    "AOD_1640nm": "aod_1640nm",
+    "Water Vapor(cm)": "water_vapor",
+    "440-870nm_Angstrom_Exponent": "angstrom_exponent_440_870",
+    "STD_340nm": "std_340nm",
+    "STD_380nm": "std_380nm",
+    "STD_440nm": "std_440nm",
+    "STD_500nm": "std_500nm",
+    "STD_675nm": "std_675nm",
+    "STD_870nm": "std_870nm",
+    "STD_1020nm": "std_1020nm",
+    "STD_1640nm": "std_1640nm",
+    "STD_Water_Vapor(cm)": "std_water_vapor",
+    "STD_440-870nm_Angstrom_Exponent": "std_angstrom_exponent_440_870",
+}
+
+# Source column -> model field for the integer columns
+INT_COLUMNS = {
+    "Number_of_Observations": "num_observations",
+    "AERONET_Number": "aeronet_number",
+    "Microtops_Number": "microtops_number",
+}
+
+# Column order used for the staging table, the COPY stream and the merge
+MEASUREMENT_COLUMNS = (
+    ["site_id", "filename", "date", "time", "latlng", "last_processing_date"]
+    + list(FLOAT_COLUMNS.values())
+    + list(INT_COLUMNS.values())
+)
+
+# Natural key of a measurement, backed by the unique constraint on both models
+CONFLICT_COLUMNS = ["site_id", "filename", "date", "time"]
+
+DATE_FORMAT = "%d:%m:%Y"
+
+# Files up to this size are parsed in one pass; larger ones are read in chunks
+# of roughly CHUNK_BYTES each.
+FULL_PARSE_THRESHOLD = 32 * 1024 * 1024
+CHUNK_BYTES = 8 * 1024 * 1024
+
+# Disclaimer lines plus the column header row at the top of every daily file
+HEADER_LINES = 5
+
+MODEL_CLASSES = {
+    "daily.lev15": SiteMeasurementsDaily15,
+    "daily.lev20": SiteMeasurementsDaily20,
+}
+
+
+def _average_line_bytes(lev_file, sample_bytes=64 * 1024):
+    if isinstance(lev_file, (str, os.PathLike)):
+        with open(lev_file, "rb") as f:
+            sample = f.read(sample_bytes)
+    else:
+        sample = lev_file.read(sample_bytes)
+        lev_file.seek(0)
+    return max(1, len(sample) // max(1, sample.count(b"\n")))
+
+
+def read_daily_file(
+    lev_file, size, full_parse_threshold=FULL_PARSE_THRESHOLD, chunk_bytes=CHUNK_BYTES
+):
+    """
+    Yield the data rows of a daily file as DataFrames.
+
+    Every row is read exactly once: small files come back as a single frame,
+    large ones in chunks sized from chunk_bytes and the file's average line
+    length.
+    """
+    options = {"skiprows": HEADER_LINES, "header": None, "encoding": "latin-1"}
+    if size <= full_parse_threshold:
+        yield pd.read_csv(lev_file, **options)
+        return
+
+    rows = max(1, chunk_bytes // _average_line_bytes(lev_file))
+    yield from pd.read_csv(lev_file, chunksize=rows, **options)
+
+
+def _as_array(frame, columns, dtype, fill=None):
+    # One cast for the whole block; only fall back to per-column coercion when the
+    # file carries stray non-numeric values. Missing or unparseable values become
+    # fill (the columns are NOT NULL), or stay NaN when fill is None.
+    try:
+        values = frame[columns].to_numpy(dtype=dtype)
+    except (ValueError, TypeError):
+        coerced = frame[columns].apply(pd.to_numeric, errors="coerce")
+        if fill is not None:
+            coerced = coerced.fillna(fill)
+        return coerced.to_numpy(dtype=dtype)
+    if fill is not None and values.dtype.kind == "f":
+        values = np.where(np.isnan(values), fill, values)
+    return values
+
+
+def transform_frame(frame, site_name, filename):
+    """
+    Column-wise conversion of a parsed daily file into a typed record batch.
+
+    Returns a DataFrame with the MEASUREMENT_COLUMNS columns, ready for
+    bulk_load. Rows whose dates or coordinates cannot be parsed are dropped.
+    """
+    frame.columns = DAILY_HEADER
+
+    dates = pd.to_datetime(frame["Date(dd:mm:yyyy)"], format=DATE_FORMAT, errors="coerce")
+    processed = pd.to_datetime(
+        frame["Last_Processing_Date(dd:mm:yyyy)"], format=DATE_FORMAT, errors="coerce"
+    )
+    coords = _as_array(frame, ["Longitude", "Latitude"], np.float64)
+    floats = _as_array(frame, list(FLOAT_COLUMNS), np.float64, fill=-999.0)
+    ints = _as_array(frame, list(INT_COLUMNS), np.int64, fill=0)
+
+    # EWKT is accepted by both COPY into a geometry column and GeometryField lookups
+    lng = pd.Series(coords[:, 0], index=frame.index).astype(str)
+    lat = pd.Series(coords[:, 1], index=frame.index).astype(str)
+    latlng = "SRID=4326;POINT(" + lng + " " + lat + ")"
+
+    batch = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "site_id": site_name,
+                    "filename": filename,
+                    "date": dates,
+                    "time": frame["Time(hh:mm:ss)"].astype(str),
+                    "latlng": latlng,
+                    "last_processing_date": processed,
+                },
+                index=frame.index,
+            ),
+            pd.DataFrame(floats, columns=list(FLOAT_COLUMNS.values()), index=frame.index),
+            pd.DataFrame(ints, columns=list(INT_COLUMNS.values()), index=frame.index),
+        ],
+        axis=1,
+    )
+
+    valid = (dates.notna() & processed.notna()).to_numpy() & np.isfinite(coords).all(axis=1)
+    # TODO: Log to file
+    if not valid.all():
+        print(f"Skipping {int((~valid).sum())} unparseable rows in {filename}")
+    return batch[valid]
+
+
+def batch_records(batch):
+    # Python-typed dicts for the ORM path
+    return batch.assign(
+        date=batch["date"].dt.date,
+        last_processing_date=batch["last_processing_date"].dt.date,
+    ).to_dict("records")
+
+
+def resolve_site(site_name, aeronet_number=0):
+    site, _ = Site.objects.get_or_create(
+        name=site_name,
+        defaults={"description": "", "span_date": [], "aeronet_number": aeronet_number},
+    )
+    return site
+
+
+def bulk_load(model, batch):
+    """
+    COPY a record batch into a staging table and upsert it into the model's table.
+
+    Duplicate keys inside the batch keep the most recently processed row.
+    Returns the number of rows inserted or updated.
+    """
+    if batch.empty:
+        return 0
+
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns = ", ".join(MEASUREMENT_COLUMNS)
+    conflict = ", ".join(CONFLICT_COLUMNS)
+    updates = ", ".join(
+        f"{column} = EXCLUDED.{column}"
+        for column in MEASUREMENT_COLUMNS
+        if column not in CONFLICT_COLUMNS
+    )
+
+    buffer = io.StringIO()
+    batch[MEASUREMENT_COLUMNS].to_csv(
+        buffer, header=False, index=False, date_format="%Y-%m-%d"
+    )
+    buffer.seek(0)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS measurement_staging")
+        cursor.execute(
+            f"CREATE TEMP TABLE measurement_staging ON COMMIT DROP AS "
+            f"SELECT {columns} FROM {table} WITH NO DATA"
+        )
+        cursor.copy_expert(
+            f"COPY measurement_staging ({columns}) FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+        cursor.execute(
+            f"INSERT INTO {table} ({columns}) "
+            f"SELECT DISTINCT ON ({conflict}) {columns} FROM measurement_staging "
+            f"ORDER BY {conflict}, last_processing_date DESC "
+            f"ON CONFLICT ({conflict}) DO UPDATE SET {updates}"
+        )
+        return cursor.rowcount
+
+
+def file_checksum(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_fingerprint(lev_file):
+    # lev_file is either a path under ./src or the raw bytes of a streamed tar member
+    if isinstance(lev_file, bytes):
+        return len(lev_file), hashlib.sha256(lev_file).hexdigest()
+    return os.path.getsize(lev_file), file_checksum(lev_file)
+
+
+def file_unchanged(filename, size, checksum):
+    return IngestManifest.objects.filter(
+        filename=filename, size=size, checksum=checksum
+    ).exists()
+
+
+def clear_file_rows(model, site_name, filename):
+    # Rows of a changed file are replaced wholesale rather than merged
+    deleted = model.objects.filter(site_id=site_name, filename=filename).delete()[0]
+    if deleted:
+        # Queryset deletes skip Model.delete(), so flag the span for refresh here
+        Site(pk=site_name).update_span_date()
+    return deleted
+
+
+def record_file(model, site_name, filename, size, checksum):
+    last_processing = model.objects.filter(
+        site_id=site_name, filename=filename
+    ).aggregate(last=Max("last_processing_date"))["last"]
+    IngestManifest.objects.update_or_create(
+        filename=filename,
+        defaults={
+            "site": site_name,
+            "size": size,
+            "checksum": checksum,
+            "last_processing_date": last_processing,
+        },
+    )
@@ -0,0 +1,116 @@
+"""
+Background download jobs.
+
+A POST to download/jobs/ stores a DownloadJob and hands it to a thread pool
+in the web process, capped at settings.DOWNLOAD_JOB_WORKERS concurrent
+builds. The worker writes the archive into the archive cache
+(archive_cache.py) and records progress on the job row, which clients poll
+until it is done and then fetch the archive. No broker is involved; state
+lives in the database, so any web process can answer a poll.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils.timezone import now
+
+from .archive import archive_folder, archive_stream, selected_files
+from .archive_cache import archive_key, cached_archive, store_archive
+from .models import DownloadJob
+
+DOWNLOAD_JOB_WORKERS = getattr(settings, "DOWNLOAD_JOB_WORKERS", 2)
+
+# A running job whose row has not been touched for this long lost its worker
+# (e.g. the process was restarted) and is reported as failed. The queue lives
+# in the web process's memory, so a restart also drops every queued job; a job
+# still pending this long after it was created is reported as failed too.
+STALE_JOB_SECONDS = getattr(settings, "DOWNLOAD_JOB_STALE_SECONDS", 15 * 60)
+
+# Progress is written back at most once per this many archive bytes, in
+# addition to once per source file
+PROGRESS_BYTES = 64 * 1024 * 1024
+
+executor = ThreadPoolExecutor(
+    max_workers=DOWNLOAD_JOB_WORKERS, thread_name_prefix="download-job"
+)
+
+
+def submit(selection):
+    job = DownloadJob.objects.create(params=selection)
+    executor.submit(run_job, job.pk)
+    return job
+
+
+def _update(job_id, **fields):
+    DownloadJob.objects.filter(pk=job_id).update(updated_at=now(), **fields)
+
+
+def run_job(job_id):
+    try:
+        # A job that waited so long it was already expired is not started
+        claimed = DownloadJob.objects.filter(
+            pk=job_id, status=DownloadJob.PENDING
+        ).update(status=DownloadJob.RUNNING, updated_at=now())
+        if not claimed:
+            return
+
+        job = DownloadJob.objects.get(pk=job_id)
+        selection = job.params
+        key = archive_key(selection)
+        _update(job_id, files_total=sum(1 for _ in selected_files(selection)))
+
+        path = cached_archive(key)
+        if not path:
+            folder = archive_folder(key)
+            state = {"bytes": 0, "reported": 0}
+
+            def progress(files_done):
+                _update(job_id, files_done=files_done, bytes_written=state["bytes"])
+                state["reported"] = state["bytes"]
+
+            chunks = store_archive(
+                archive_stream(selection, folder, progress=progress), key, folder
+            )
+            for chunk in chunks:
+                state["bytes"] += len(chunk)
+                if state["bytes"] - state["reported"] >= PROGRESS_BYTES:
+                    _update(job_id, bytes_written=state["bytes"])
+                    state["reported"] = state["bytes"]
+
+            path = cached_archive(key)
+            if not path:
+                raise RuntimeError("Archive is larger than the archive cache")
+
+        _update(
+            job_id,
+            status=DownloadJob.DONE,
+            files_done=F("files_total"),
+            bytes_written=os.path.getsize(path),
+            archive_key=key,
+            archive_path=path,
+            finished_at=now(),
+        )
+    # TODO: Log exceptions to log file
+    except Exception as e:
+        print(f"Download job {job_id} failed: {e}")
+        _update(job_id, status=DownloadJob.FAILED, error=str(e), finished_at=now())
+    finally:
+        # Worker threads open their own connection; don't leave it idle
+        connection.close()
+
+
+def expire_stale(job):
+    """Mark job failed if its worker or queue has gone away, and return it."""
+    stale = now() - timedelta(seconds=STALE_JOB_SECONDS)
+    if (job.status == DownloadJob.RUNNING and job.updated_at < stale) or (
+        job.status == DownloadJob.PENDING and job.created_at < stale
+    ):
+        job.status = DownloadJob.FAILED
+        job.error = "Job was interrupted; please submit it again"
+        job.finished_at = now()
+        job.save(update_fields=["status", "error", "finished_at", "updated_at"])
+    return job
@@ -0,0 +1,70 @@
+"""
+Line-level filtering of source files for downloads.
+
+Only the date, latitude and longitude fields of a line are looked at (found
+by name in the column header), and matching lines are passed through byte
+for byte, so a filtered file is an exact subset of the source.
+"""
+
+DATE_COLUMN = b"Date(dd:mm:yyyy)"
+LAT_COLUMN = b"Latitude"
+LNG_COLUMN = b"Longitude"
+
+
+def line_date(field):
+    # b"dd:mm:yyyy" -> "yyyy-mm-dd", or None if the field is not a date
+    if len(field) != 10 or field[2:3] != b":" or field[5:6] != b":":
+        return None
+    day, month, year = field[:2], field[3:5], field[6:]
+    if not (day.isdigit() and month.isdigit() and year.isdigit()):
+        return None
+    return f"{year.decode()}-{month.decode()}-{day.decode()}"
+
+
+def line_filter(header_line, start_date=None, end_date=None, bounds=None):
+    """
+    Predicate telling whether a raw data line falls within [start_date,
+    end_date] ("YYYY-MM-DD") and bounds (min_lat/max_lat/min_lng/max_lng,
+    None for no limit). Lines with an unreadable date or coordinate fail a
+    check that needs it. Raises ValueError if header_line lacks a column that
+    is needed.
+    """
+    columns = header_line.rstrip(b"\r\n").split(b",")
+    limits = {key: float(value) for key, value in (bounds or {}).items() if value}
+
+    by_date = bool(start_date or end_date)
+    by_lat = "min_lat" in limits or "max_lat" in limits
+    by_lng = "min_lng" in limits or "max_lng" in limits
+    date_column = columns.index(DATE_COLUMN) if by_date else 0
+    lat_column = columns.index(LAT_COLUMN) if by_lat else 0
+    lng_column = columns.index(LNG_COLUMN) if by_lng else 0
+    if not (by_date or by_lat or by_lng):
+        return lambda line: True
+
+    # Split no further than the last column that is compared
+    last = max(date_column, lat_column, lng_column)
+    min_lat = limits.get("min_lat", float("-inf"))
+    max_lat = limits.get("max_lat", float("inf"))
+    min_lng = limits.get("min_lng", float("-inf"))
+    max_lng = limits.get("max_lng", float("inf"))
+
+    def keep(line):
+        fields = line.split(b",", last + 1)
+        if len(fields) <= last:
+            return False
+        if by_date:
+            day = line_date(fields[date_column].strip())
+            if day is None:
+                return False
+            if (start_date and day < start_date) or (end_date and day > end_date):
+                return False
+        try:
+            if by_lat and not min_lat <= float(fields[lat_column]) <= max_lat:
+                return False
+            if by_lng and not min_lng <= float(fields[lng_column]) <= max_lng:
+                return False
+        except ValueError:
+            return False
+        return True
+
+    return keep
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from maritimeapp.models import DatasetVersion, SiteMeasurementsDaily15, SiteMeasurementsDaily20
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete measurement rows that repeat a (site, filename, date, time) key, keeping "
+        "the most recently processed one. Run before the migration that adds the "
+        "unique_daily15/20_measurement constraints to a database loaded by older versions."
+    )
+
+    def handle(self, *args, **options):
+        removed = 0
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in (SiteMeasurementsDaily15, SiteMeasurementsDaily20):
+                table = connection.ops.quote_name(model._meta.db_table)
+                # Same tie-break as bulk_load: latest last_processing_date, then latest id
+                cursor.execute(
+                    f"""
+                    DELETE FROM {table} AS a
+                    USING {table} AS b
+                    WHERE a.site_id = b.site_id
+                    AND a.filename = b.filename
+                    AND a.date = b.date
+                    AND a.time = b.time
+                    AND (a.last_processing_date, a.id) < (b.last_processing_date, b.id)
+                    """
+                )
+                removed += cursor.rowcount
+                self.stdout.write(f"{model.__name__}: {cursor.rowcount} duplicate rows removed")
+
+        if removed:
+            DatasetVersion.bump()
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} duplicate measurement rows"))
@@ -0,0 +1,66 @@
+from django.contrib.gis.geos import Polygon
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.utils.dateparse import parse_date
+
+from maritimeapp.models import Site, SiteMeasurementsDaily15
+
+
+class Command(BaseCommand):
+    help = "Run EXPLAIN ANALYZE on the API's representative queries and report which indexes they use"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sites", default="", help="Comma separated site names (default: the 5 largest sites)")
+        parser.add_argument("--reading", default="aod_500nm")
+        parser.add_argument("--start-date", default=None)
+        parser.add_argument("--end-date", default=None)
+        parser.add_argument(
+            "--bbox",
+            default="-180,-90,180,90",
+            help="min_lng,min_lat,max_lng,max_lat",
+        )
+
+    def handle(self, *args, **options):
+        reading = options["reading"]
+        site_names = [name for name in options["sites"].split(",") if name]
+        if not site_names:
+            site_names = list(
+                SiteMeasurementsDaily15.objects.values("site")
+                .annotate(rows=Count("id"))
+                .order_by("-rows")
+                .values_list("site", flat=True)[:5]
+            )
+
+        bbox = Polygon.from_bbox(tuple(float(value) for value in options["bbox"].split(",")))
+
+        measurements = SiteMeasurementsDaily15.objects.filter(
+            site__in=Site.objects.filter(name__in=site_names),
+            latlng__within=bbox,
+        ).exclude(**{reading: -999})
+        if options["start_date"]:
+            measurements = measurements.filter(date__gte=parse_date(options["start_date"]))
+        if options["end_date"]:
+            measurements = measurements.filter(date__lte=parse_date(options["end_date"]))
+
+        queries = {
+            "site_measurements": measurements.values(
+                "site", "filename", "date", "time", "latlng", "aeronet_number", reading
+            ),
+            "list_sites bbox": SiteMeasurementsDaily15.objects.filter(latlng__within=bbox)
+            .values_list("site_id", flat=True)
+            .distinct(),
+        }
+
+        index_names = {index.name for index in SiteMeasurementsDaily15._meta.indexes}
+
+        for label, queryset in queries.items():
+            plan = queryset.explain(analyze=True, buffers=True)
+            used = sorted(name for name in index_names if name in plan)
+            self.stdout.write(self.style.MIGRATE_HEADING(f"== {label} (sites: {', '.join(site_names)})"))
+            self.stdout.write(plan)
+            if used:
+                self.stdout.write(self.style.SUCCESS(f"Indexes used: {', '.join(used)}"))
+            elif "Seq Scan" in plan:
+                self.stdout.write(self.style.WARNING("No measurement index used (sequential scan)"))
+            else:
+                self.stdout.write("No measurement-specific index used")
@@ -1,18 +1,41 @@
 import concurrent.futures
+import contextlib
 import logging
 import os
 import io
 import numpy as np
 import tarfile
+import time
+import django
 import requests
+from django.apps import apps
 from django.core.management.base import BaseCommand
 from rest_framework.exceptions import ValidationError
 from maritimeapp.models import *
-from django.contrib.gis.geos import Point
-import pandas as pd
+from maritimeapp.models import defer_span_updates
+from django.db import connections, transaction
 from django.db.models import Min, Max
+from maritimeapp.archive import FILE_ENDINGS
+from maritimeapp.date_index import ensure_index
+from maritimeapp.ingest import (
+    CHUNK_BYTES,
+    FULL_PARSE_THRESHOLD,
+    MODEL_CLASSES,
+    batch_records,
+    bulk_load,
+    clear_file_rows,
+    file_unchanged,
+    read_daily_file,
+    record_file,
+    resolve_site,
+    source_fingerprint,
+    transform_frame,
+)
 
-NUM_WORKERS = 5
+NUM_WORKERS = os.cpu_count() or 1
+
+MAN_DATA_URL = "https://aeronet.gsfc.nasa.gov/new_web/All_MAN_Data_V3.tar.gz"
+SRC_DIR = os.path.join(".", "src")
 
 format_one = [
     "all_points.lev10",
@@ -26,116 +49,145 @@ format_two = [
     "series.lev20",
 ]
 
+
+@contextlib.contextmanager
+def open_source(source):
+    """
+    Yield a binary stream of the MAN archive.
+
+    source is either a local file path or an http(s) URL; URLs are read as a
+    stream so the archive is never held in memory as a whole.
+    """
+    if os.path.isfile(source):
+        with open(source, "rb") as f:
+            yield f
+        return
+
+    with requests.get(source, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        yield response.raw
+
+
+def init_worker():
+    # Runs once in each pool process: make sure Django is configured (spawn start
+    # method) and drop any connection inherited from the parent so the worker
+    # opens its own on first use.
+    if not apps.ready:
+        django.setup()
+    connections.close_all()
+
+
+def index_source(path):
+    # Runs inside a pool process; errors are returned rather than raised so one
+    # unreadable file does not abort the rest
+    try:
+        return path, ensure_index(path), None
+    except Exception as e:
+        return path, False, e
+
+
+def safe_member_path(root, member_name):
+    # Resolve a tar member under root, refusing absolute paths and ../ escapes
+    path = os.path.realpath(os.path.join(root, member_name))
+    if os.path.commonpath([os.path.realpath(root), path]) != os.path.realpath(root):
+        raise ValueError(f"Refusing to write tar member outside {root}: {member_name}")
+    return path
+
 class Command(BaseCommand):
     help = "Download and process file from static URL"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--bulk",
+            action="store_true",
+            help="Load whole files through COPY into a staging table and upsert, instead of per-row get_or_create",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Reload every file even if the ingest manifest shows it unchanged",
+        )
+        parser.add_argument(
+            "--source",
+            default=MAN_DATA_URL,
+            help="URL or local path of the MAN tar.gz archive",
+        )
+        parser.add_argument(
+            "--stream",
+            action="store_true",
+            help="Parse daily files straight out of the gzip stream as they arrive, without extracting the archive first",
+        )
+        parser.add_argument(
+            "--keep-src",
+            action="store_true",
+            help="With --stream, also write every member under ./src as it streams past (download_data reads from there)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=NUM_WORKERS,
+            help="Number of ingest processes (default: number of CPU cores)",
+        )
+        parser.add_argument(
+            "--full-parse-threshold",
+            type=int,
+            default=FULL_PARSE_THRESHOLD,
+            help="Files up to this many bytes are parsed in one pass",
+        )
+        parser.add_argument(
+            "--chunk-bytes",
+            type=int,
+            default=CHUNK_BYTES,
+            help="Approximate bytes per chunk when reading larger files",
+        )
+        parser.add_argument(
+            "--site-stats",
+            action="store_true",
+            help="Also build per-site reading statistics for get_display_info",
+        )
+
     @classmethod
     def process_chunk(cls, chunk, filetype, site_name, file):
+        """
+        Store the rows of one chunk. Returns (rows written, rows that failed).
+        """
         print(f"Processing : {site_name}")
-        model_classes = {
-            format_two[0]: SiteMeasurementsDaily15,
-            format_two[1]: SiteMeasurementsDaily20,
-        }
-        model = model_classes.get(filetype)
-        
-        daily_header = [
-            "Date(dd:mm:yyyy)",
-            "Time(hh:mm:ss)",
-            "Air Mass",
-            "Latitude",
-            "Longitude",
-            "AOD_340nm",
-            "AOD_380nm",
-            "AOD_440nm",
-            "AOD_500nm",
-            "AOD_675nm",
-            "AOD_870nm",
-            "AOD_1020nm",
-            "AOD_1640nm",
-            "Water Vapor(cm)",
-            "440-870nm_Angstrom_Exponent",
-            "STD_340nm",
-            "STD_380nm",
-            "STD_440nm",
-            "STD_500nm",
-            "STD_675nm",
-            "STD_870nm",
-            "STD_1020nm",
-            "STD_1640nm",
-            "STD_Water_Vapor(cm)",
-            "STD_440-870nm_Angstrom_Exponent",
-            "Number_of_Observations",
-            "Last_Processing_Date(dd:mm:yyyy)",
-            "AERONET_Number",
-            "Microtops_Number",
-        ]
-        chunk.columns = daily_header
+        model = MODEL_CLASSES.get(filetype)
 
-        for _, row in chunk.iterrows():
-            try:
-                full_file_name = file + filetype
+        batch = transform_frame(chunk, site_name, file + filetype)
+        if batch.empty:
+            return 0, 0
 
-                # Extract latlng and date
-                latlng = Point(float(row["Longitude"]), float(row["Latitude"]))
-                date_str = row["Date(dd:mm:yyyy)"].split(":")
-                date = f"{date_str[2]}-{date_str[1]}-{date_str[0]}"
+        # Create or get the Site object
+        site_obj = resolve_site(site_name, int(batch["aeronet_number"].iloc[0]))
 
-                last_processing = row["Last_Processing_Date(dd:mm:yyyy)"].split(":")
-                last_processing_date = f"{last_processing[2]}-{last_processing[1]}-{last_processing[0]}"
+        written = failed = 0
+        for record in batch_records(batch):
+            try:
+                del record["site_id"]
+                # Savepoint per row, so one bad row does not abort the file's transaction
+                with transaction.atomic():
+                    model.objects.get_or_create(site=site_obj, **record)
+                written += 1
 
-                # Create or get the Site object
-                site_obj, created = Site.objects.get_or_create(
-                    name=site_name,
-                            defaults={"description": "", "span_date": [], "aeronet_number": row["AERONET_Number"]}
-                )
-            
-                model.objects.get_or_create(
-                site=site_obj,  
-                filename=full_file_name,
-                date=date,
-                time=row["Time(hh:mm:ss)"],
-                air_mass=float(row["Air Mass"]),
-                latlng=latlng,
-                aod_340nm=float(row["AOD_340nm"]),
-                aod_380nm=float(row["AOD_380nm"]),
-                aod_440nm=float(row["AOD_440nm"]),
-                aod_500nm=float(row["AOD_500nm"]),
-                aod_675nm=float(row["AOD_675nm"]),
-                aod_870nm=float(row["AOD_870nm"]),
-                aod_1020nm=float(row["AOD_1020nm"]),
-                aod_1640nm=float(row["AOD_1640nm"]),
-                water_vapor=float(row["Water Vapor(cm)"]),
-                angstrom_exponent_440_870=float(
-                    row["440-870nm_Angstrom_Exponent"]
-                ),
-                std_340nm=float(row["STD_340nm"]),
-                std_380nm=float(row["STD_380nm"]),
-                std_440nm=float(row["STD_440nm"]),
-                std_500nm=float(row["STD_500nm"]),
-                std_675nm=float(row["STD_675nm"]),
-                std_870nm=float(row["STD_870nm"]),
-                std_1020nm=float(row["STD_1020nm"]),
-                std_1640nm=float(row["STD_1640nm"]),
-                std_water_vapor=float(row["STD_Water_Vapor(cm)"]),
-                std_angstrom_exponent_440_870=float(
-                    row["STD_440-870nm_Angstrom_Exponent"]
-                ),
-                num_observations=int(row["Number_of_Observations"]),
-                last_processing_date=last_processing_date,
-                aeronet_number=int(row["AERONET_Number"]),
-                microtops_number=int(row["Microtops_Number"]),
-                )
-            
             # TODO: Log to file
             except Exception as e:
-                print(row)
+                failed += 1
+                print(record)
                 print(e)
 
-    def process_file(self, args):
-        member = args[0]
-        lev_file = args[1]
-        file_name = args[2]
-        file_type = args[3]
+        return written, failed
+
+    @classmethod
+    def process_file(cls, args):
+        """
+        Load one daily file; runs inside a pool process.
+
+        Returns (filename, status, rows, seconds) so the parent can report progress.
+        """
+        member, lev_file, file_name, file_type, opts = args
+        started = time.monotonic()
 
         print("FILENAME: ", file_name)
         site = None
@@ -146,85 +198,247 @@ class Command(BaseCommand):
         except Exception as e:
             print("Site Name change error occurred", e)
 
-        chunk_size = 50
-        reader = pd.read_csv(
-            lev_file,
-            nrows=chunk_size,
-            skiprows=5,
-            header=None,
-            chunksize=chunk_size,
-            encoding="latin-1",
+        # Skip files whose size and checksum match the last successful load
+        full_file_name = file_name + file_type
+        model = MODEL_CLASSES[file_type]
+        size, checksum = source_fingerprint(lev_file)
+        if not opts["force"] and file_unchanged(full_file_name, size, checksum):
+            return full_file_name, "skipped", 0, time.monotonic() - started
+
+        if isinstance(lev_file, bytes):
+            lev_file = io.BytesIO(lev_file)
+
+        reader = read_daily_file(
+            lev_file, size, opts["full_parse_threshold"], opts["chunk_bytes"]
         )
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-            futures = [
-                executor.submit(self.process_chunk, chunk, file_type, site, file_name)
-                for chunk in reader
-            ]
-            concurrent.futures.wait(futures)
+        # Span dates of the touched site are recomputed once, after the file is in.
+        # The file's rows are swapped in one transaction so readers never see it half
+        # loaded.
+        failed = 0
+        with defer_span_updates(), transaction.atomic():
+            clear_file_rows(model, site, full_file_name)
+            if opts["bulk"]:
+                rows = cls.process_file_bulk(reader, file_type, site, file_name)
+            else:
+                rows = 0
+                for chunk in reader:
+                    written, errors = cls.process_chunk(chunk, file_type, site, file_name)
+                    rows += written
+                    failed += errors
+            # A file with rows that could not be stored is not recorded, so the next
+            # run loads it again instead of skipping it as unchanged
+            if not failed:
+                record_file(model, site, full_file_name, size, checksum)
+
+        status = "failed" if failed else "loaded"
+        return full_file_name, status, rows, time.monotonic() - started
+
+    @staticmethod
+    def process_file_bulk(reader, file_type, site_name, file):
+        # One site lookup and one span update per file, one COPY + upsert per chunk;
+        # bulk_load bypasses save(), so the site is marked for a span refresh here
+        site_obj = None
+        loaded = 0
+        for frame in reader:
+            batch = transform_frame(frame, site_name, file + file_type)
+            if batch.empty:
+                continue
+
+            if site_obj is None:
+                site_obj = resolve_site(site_name, int(batch["aeronet_number"].iloc[0]))
+            loaded += bulk_load(MODEL_CLASSES[file_type], batch)
+
+        if site_obj is not None:
+            site_obj.update_span_date()
+        return loaded
 
     def handle(self, *args, **options):
+        self.file_options = {
+            "bulk": options["bulk"],
+            "force": options["force"],
+            "full_parse_threshold": options["full_parse_threshold"],
+            "chunk_bytes": options["chunk_bytes"],
+        }
+        self.workers = max(1, options["workers"])
+        self.site_stats = options["site_stats"]
+        self.progress = {"loaded": 0, "skipped": 0, "failed": 0, "rows": 0, "seconds": 0.0}
+        self.failures = []
         print("Attempting Session")
-        file_endings = [
-            "all_points.lev10",
-            "all_points.lev15",
-            "all_points.lev20",
-            "series.lev15",
-            "series.lev20",
-            "daily.lev15",
-            "daily.lev20",
-        ]
 
-        # Download the MAN file from the static URL
-        url = "https://aeronet.gsfc.nasa.gov/new_web/All_MAN_Data_V3.tar.gz"
-        response = requests.get(url)
-        
-        if not response.ok:
-            print("Server Offline. Attempt again Later.")
+        if options["stream"]:
+            self.handle_stream(options["source"], options["keep_src"])
             return
-        
-        tar_contents = response.content
+
+        # Download the MAN file from the static URL
+        source = options["source"]
+        if os.path.isfile(source):
+            with open(source, "rb") as f:
+                tar_contents = f.read()
+        else:
+            response = requests.get(source)
+
+            if not response.ok:
+                print("Server Offline. Attempt again Later.")
+                return
+
+            tar_contents = response.content
 
         with tarfile.open(fileobj=io.BytesIO(tar_contents), mode="r:gz") as tar:
-            tar.extractall(path=r"./src")
+            tar.extractall(path=SRC_DIR)
         print("MAN Data Downloaded ...")
 
         # Read the folder contents
-        folder_path = os.path.join(".", "src")
+        folder_path = SRC_DIR
         if os.path.exists(folder_path):
             print("Folder exist -> moving to creating threaded processes")
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-            futures = []
+        started = time.monotonic()
+        with self.create_pool() as executor:
+            futures = {}
             for root, dirs, files in os.walk(folder_path):
                 for file_name in files:
-                    # Insert/Update Daily Level 15
-                    if file_name.endswith(file_endings[4]):
-                        file_path = os.path.join(root, file_name)
-                        file_name = file_name[: -len(file_endings[4])]
-                        print(f"Submitting file {file_name} to thread pool")
-                        futures.append(
-                            executor.submit(
-                                self.process_file,
-                                (file_path, file_path, file_name, file_endings[4]),
-                            )
-                        )
-
-                    # Insert/Update Daily Level 20
-                    if file_name.endswith(file_endings[5]):
-                        file_path = os.path.join(root, file_name)
-                        file_name = file_name[: -len(file_endings[5])]
-                        print(f"Submitting file {file_name} to thread pool")
-                        futures.append(
-                            executor.submit(
-                                self.process_file,
-                                (file_path, file_path, file_name, file_endings[5]),
-                            )
-                        )
-
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    future.result()
-                except Exception as exc:
-                    print(f"Exception occurred: {exc}")
+                    # Insert/Update Daily Level 15 and Level 20
+                    file_type = next(
+                        (ending for ending in MODEL_CLASSES if file_name.endswith(ending)),
+                        None,
+                    )
+                    if file_type is None:
+                        continue
+
+                    file_path = os.path.join(root, file_name)
+                    file_name = file_name[: -len(file_type)]
+                    print(f"Submitting file {file_name} to process pool")
+                    future = executor.submit(
+                        self.process_file,
+                        (file_path, file_path, file_name, file_type, self.file_options),
+                    )
+                    futures[future] = file_name + file_type
+
+            self.report(concurrent.futures.as_completed(futures), futures)
+            # Invalidate cached responses before the (slower) index build
+            self.summarize(started)
+            self.publish()
+            self.index_sources(executor)
+
+    def create_pool(self):
+        # Close the parent's connection so forked workers do not share its socket
+        connections.close_all()
+        print(f"Starting {self.workers} ingest processes")
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, initializer=init_worker
+        )
+
+    def handle_stream(self, source, keep_src):
+        # Members are handed to the pool as soon as they are read from the stream;
+        # at most 2 * workers member buffers are held in memory at once.
+        started = time.monotonic()
+        with open_source(source) as stream, tarfile.open(
+            fileobj=stream, mode="r|gz"
+        ) as tar, self.create_pool() as executor:
+            futures = {}
+            for member in tar:
+                if not member.isfile():
+                    continue
+
+                base_name = os.path.basename(member.name)
+                file_type = next(
+                    (ending for ending in MODEL_CLASSES if base_name.endswith(ending)),
+                    None,
+                )
+                if file_type is None and not keep_src:
+                    continue
+
+                data = tar.extractfile(member).read()
+
+                if keep_src:
+                    target = safe_member_path(SRC_DIR, member.name)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with open(target, "wb") as f:
+                        f.write(data)
+
+                if file_type is None:
+                    continue
+
+                file_name = base_name[: -len(file_type)]
+                print(f"Submitting streamed file {file_name} to process pool")
+                future = executor.submit(
+                    self.process_file,
+                    (member.name, data, file_name, file_type, self.file_options),
+                )
+                futures[future] = base_name
+
+                if len(futures) >= 2 * self.workers:
+                    done, _ = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    self.report(done, futures)
+
+            self.report(concurrent.futures.as_completed(list(futures)), futures)
+            print("MAN Data Streamed ...")
+            self.summarize(started)
+            self.publish()
+            if keep_src:
+                self.index_sources(executor)
 
+    def index_sources(self, executor):
+        # Byte-offset date indexes let date-filtered downloads seek instead of parsing
+        paths = [
+            os.path.join(root, file_name)
+            for root, dirs, files in os.walk(SRC_DIR)
+            for file_name in files
+            if any(file_name.endswith(ending) for ending in FILE_ENDINGS)
+        ]
+        built = failed = 0
+        for path, rebuilt, error in executor.map(index_source, paths, chunksize=16):
+            if error is not None:
+                failed += 1
+                # TODO: Log to file
+                print(f"Date index failed for {path}: {error}")
+            built += rebuilt
+        print(
+            f"Date indexes: {built} built, {failed} failed, "
+            f"{len(paths) - built - failed} up to date or not indexable"
+        )
+
+    def report(self, done, futures):
+        # Collect results from the workers; finished futures are removed from futures
+        for future in done:
+            file_name = futures.pop(future)
+            try:
+                _, status, rows, seconds = future.result()
+            except Exception as exc:
+                self.progress["failed"] += 1
+                self.failures.append((file_name, exc))
+                print(f"Exception occurred in {file_name}: {exc}")
+                continue
+
+            self.progress[status] += 1
+            self.progress["rows"] += rows
+            self.progress["seconds"] += seconds
+            if status == "failed":
+                self.failures.append((file_name, "some rows could not be stored"))
+            print(
+                f"[{self.progress['loaded'] + self.progress['skipped'] + self.progress['failed']}] "
+                f"{file_name}: {status} ({rows} rows, {rows / max(seconds, 1e-6):.0f} rows/s)"
+            )
+
+    def publish(self):
+        # Refresh the reading statistics, then invalidate cached API responses
+        # once new data is in
+        if self.progress["loaded"] or self.progress["rows"]:
+            stored = ReadingStatistic.rebuild(per_site=self.site_stats)
+            print(f"Reading statistics rebuilt ({stored} entries)")
+            version = DatasetVersion.bump()
+            print(f"Dataset version bumped to {version}")
+
+    def summarize(self, started):
+        elapsed = time.monotonic() - started
+        print(
+            f"Ingest finished in {elapsed:.1f}s: {self.progress['loaded']} loaded, "
+            f"{self.progress['skipped']} unchanged, {self.progress['failed']} failed, "
+            f"{self.progress['rows']} rows ({self.progress['rows'] / max(elapsed, 1e-6):.0f} rows/s overall, "
+            f"{self.progress['rows'] / max(self.progress['seconds'], 1e-6):.0f} rows/s per worker)"
+        )
+        for file_name, exc in self.failures:
+            print(f"  FAILED {file_name}: {exc}")
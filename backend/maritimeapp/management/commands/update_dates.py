@@ -1,11 +1,12 @@
 from django.core.management.base import BaseCommand
-from maritimeapp.models import Site
+from maritimeapp.models import DatasetVersion, Site, SiteExtent
 
 class Command(BaseCommand):
-    help = 'Updates span_date field for all Site records'
+    help = 'Updates span_date field and spatial extent for all Site records'
 
     def handle(self, *args, **kwargs):
-        sites = Site.objects.all()
-        for site in sites:
-            site.update_span_date()
-            self.stdout.write(self.style.SUCCESS(f'Successfully updated span_date for site: {site.name}'))
+        # One set-based UPDATE ... FROM (GROUP BY site_id) for every site
+        updated = Site.refresh_span_dates()
+        SiteExtent.refresh()
+        DatasetVersion.bump()
+        self.stdout.write(self.style.SUCCESS(f'Successfully updated span_date for {updated} sites'))
@@ -1,8 +1,74 @@
-from django.db import models
+import contextlib
+import threading
+import uuid
+
+from django.db import connection, models, transaction
 from django.contrib.gis.db import models as gis_models
-from django.contrib.gis.geos import Point
+from django.contrib.gis.geos import Point, Polygon
 from django.contrib.postgres.fields import ArrayField
-from django.db.models import Min, Max
+from django.contrib.postgres.indexes import BrinIndex
+from django.utils.timezone import now
+
+# Readings the map requests most often; each gets a partial (site, date) index
+# that leaves out the -999 "no value" rows
+INDEXED_READINGS = ["aod_440nm", "aod_500nm", "aod_870nm", "angstrom_exponent_440_870"]
+
+
+def measurement_indexes(prefix):
+    """
+    Indexes matching the site_measurements query shape: site__in +
+    date__range (extended with time, id for keyset pagination), optionally
+    with reading != -999, plus a BRIN index on date for range scans over the
+    whole table.
+    """
+    indexes = [
+        models.Index(fields=["site", "date", "time", "id"], name=f"{prefix}_site_date_key_idx"),
+        BrinIndex(fields=["date"], name=f"{prefix}_date_brin"),
+    ]
+    for reading in INDEXED_READINGS:
+        short = reading.replace("angstrom_exponent_440_870", "ae").replace("nm", "")
+        indexes.append(
+            models.Index(
+                fields=["site", "date"],
+                condition=~models.Q(**{reading: -999}),
+                name=f"{prefix}_{short}_valid_idx",
+            )
+        )
+    return indexes
+
+
+# Sites whose span_date is waiting to be recomputed inside defer_span_updates()
+_span_state = threading.local()
+
+
+@contextlib.contextmanager
+def defer_span_updates():
+    """
+    Collect the sites touched by writes inside the block and recompute their
+    span dates and extents with set-based statements when the block exits.
+
+    Nested blocks join the outermost one.
+    """
+    if getattr(_span_state, "sites", None) is not None:
+        yield _span_state.sites
+        return
+
+    _span_state.sites = set()
+    try:
+        yield _span_state.sites
+        touched = _span_state.sites
+    finally:
+        _span_state.sites = None
+
+    if touched:
+        refresh_site_summaries(touched)
+
+
+def refresh_site_summaries(site_ids=None):
+    # Everything derived from a site's measurements: span_date and SiteExtent
+    Site.refresh_span_dates(site_ids)
+    SiteExtent.refresh(site_ids)
+
 
 class Site(models.Model):
     name = models.CharField(primary_key=True, max_length=255)
@@ -16,13 +82,47 @@ class Site(models.Model):
         help_text="Array holding the span of dates [start_date, end_date]"
     )
 
+    @classmethod
+    def refresh_span_dates(cls, site_ids=None):
+        """
+        Recompute span_date from SiteMeasurementsDaily15 with a single
+        GROUP BY site_id statement, for the given sites or for all of them.
+
+        Returns the number of sites updated.
+        """
+        site_table = connection.ops.quote_name(cls._meta.db_table)
+        measurement_table = connection.ops.quote_name(SiteMeasurementsDaily15._meta.db_table)
+        where = ""
+        params = []
+        if site_ids is not None:
+            where = "WHERE site.name = ANY(%s)"
+            params.append(list(site_ids))
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                UPDATE {site_table} AS target
+                SET span_date = ARRAY[spans.start_date, spans.end_date]
+                FROM (
+                    SELECT site.name, MIN(m.date) AS start_date, MAX(m.date) AS end_date
+                    FROM {site_table} AS site
+                    LEFT JOIN {measurement_table} AS m ON m.site_id = site.name
+                    {where}
+                    GROUP BY site.name
+                ) AS spans
+                WHERE target.name = spans.name
+                """,
+                params,
+            )
+            return cursor.rowcount
+
     def update_span_date(self):
-        # Calculate the span date using related SiteMeasurementsDaily15 entries
-        dates = SiteMeasurementsDaily15.objects.filter(site=self).aggregate(
-            start_date=Min('date'),
-            end_date=Max('date')
-        )
-        Site.objects.filter(pk=self.pk).update(span_date=[dates['start_date'], dates['end_date']])
+        # Deferred to the end of the enclosing defer_span_updates() block, if any
+        touched = getattr(_span_state, "sites", None)
+        if touched is not None:
+            touched.add(self.pk)
+            return
+        refresh_site_summaries([self.pk])
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
@@ -61,6 +161,18 @@ class SiteMeasurementsDaily15(models.Model):
     aeronet_number = models.IntegerField(default=0)
     microtops_number = models.IntegerField(default=0)
 
+    class Meta:
+        constraints = [
+            # Natural key used by the bulk loader's upsert. Tables loaded before it
+            # existed may hold duplicate keys: run "manage.py dedupe_measurements"
+            # before the migration that adds it.
+            models.UniqueConstraint(
+                fields=["site", "filename", "date", "time"],
+                name="unique_daily15_measurement",
+            ),
+        ]
+        indexes = measurement_indexes("d15")
+
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         # Update the span_date in the related Site instance
@@ -104,3 +216,237 @@ class SiteMeasurementsDaily20(models.Model):
     aeronet_number = models.IntegerField(default=0)
     microtops_number = models.IntegerField(default=0)
 
+    class Meta:
+        constraints = [
+            # Natural key used by the bulk loader's upsert. Tables loaded before it
+            # existed may hold duplicate keys: run "manage.py dedupe_measurements"
+            # before the migration that adds it.
+            models.UniqueConstraint(
+                fields=["site", "filename", "date", "time"],
+                name="unique_daily20_measurement",
+            ),
+        ]
+        indexes = measurement_indexes("d20")
+
+class IngestManifest(models.Model):
+    # One row per source file loaded by populate, used to skip unchanged files
+    filename = models.CharField(primary_key=True, max_length=255)
+    site = models.CharField(max_length=255)
+    size = models.BigIntegerField(default=0)
+    checksum = models.CharField(max_length=64, default="")
+    last_processing_date = models.DateField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+class DatasetVersion(models.Model):
+    # Single row bumped by populate/update_dates; cached API responses carry
+    # the version they were built from and are discarded once it changes.
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def current(cls):
+        obj, _ = cls.objects.get_or_create(pk=1)
+        return obj
+
+    @classmethod
+    def bump(cls):
+        cls.current()
+        cls.objects.filter(pk=1).update(version=models.F("version") + 1, updated_at=now())
+        return cls.current().version
+
+
+class SiteExtent(models.Model):
+    # Where each site measured: its measurement positions snapped to a
+    # GRID_DEGREES grid, as a multipoint (GiST indexed). Kept up to date at
+    # ingest so list_sites can filter by bbox without scanning every
+    # measurement. Unlike a bounding box this follows the cruise track, so long
+    # crossings (or the dateline) do not make a site match every bbox.
+    GRID_DEGREES = 0.1
+
+    site = models.OneToOneField(Site, primary_key=True, on_delete=models.CASCADE, related_name="extent")
+    extent = gis_models.GeometryField(srid=4326)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def refresh(cls, site_ids=None):
+        """
+        Rebuild the extents of the given sites (or all sites) from
+        SiteMeasurementsDaily15 with one grouped upsert.
+        """
+        extent_table = connection.ops.quote_name(cls._meta.db_table)
+        measurement_table = connection.ops.quote_name(SiteMeasurementsDaily15._meta.db_table)
+        where = ""
+        params = []
+        if site_ids is not None:
+            where = "WHERE m.site_id = ANY(%s)"
+            params.append(list(site_ids))
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {extent_table} (site_id, extent, updated_at)
+                SELECT
+                    m.site_id,
+                    ST_Multi(ST_Collect(DISTINCT ST_SnapToGrid(m.latlng, %s))),
+                    now()
+                FROM {measurement_table} AS m
+                {where}
+                GROUP BY m.site_id
+                ON CONFLICT (site_id) DO UPDATE
+                SET extent = EXCLUDED.extent, updated_at = EXCLUDED.updated_at
+                """,
+                [cls.GRID_DEGREES, *params],
+            )
+            # Sites that no longer have any measurements
+            cursor.execute(
+                f"""
+                DELETE FROM {extent_table} AS e
+                WHERE {"e.site_id = ANY(%s) AND" if site_ids is not None else ""}
+                NOT EXISTS (SELECT 1 FROM {measurement_table} AS m WHERE m.site_id = e.site_id)
+                """,
+                params,
+            )
+
+    @classmethod
+    def search_boxes(cls, bbox):
+        """
+        (outer, inner) boxes for looking up bbox in the snapped extents. A
+        measurement is at most half a cell from its grid point, so sites with
+        no grid point in outer have no measurement in bbox, and sites whose
+        grid points are all in inner only have measurements in bbox. inner is
+        None when bbox is too small to hold a whole cell.
+        """
+        min_lng, min_lat, max_lng, max_lat = bbox.extent
+        margin = cls.GRID_DEGREES / 2
+        outer = Polygon.from_bbox(
+            (min_lng - margin, min_lat - margin, max_lng + margin, max_lat + margin)
+        )
+        inner = None
+        if max_lng - min_lng > 2 * margin and max_lat - min_lat > 2 * margin:
+            inner = Polygon.from_bbox(
+                (min_lng + margin, min_lat + margin, max_lng - margin, max_lat - margin)
+            )
+        for box in (outer, inner):
+            if box is not None:
+                box.srid = bbox.srid
+        return outer, inner
+
+
+class ReadingStatistic(models.Model):
+    # Distribution of each float reading (ignoring -999) per quality level, and
+    # optionally per site; rebuilt by populate and served by get_display_info
+    QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+    quality = models.CharField(max_length=16)
+    site = models.CharField(max_length=255, blank=True, default="", help_text="Empty for all sites")
+    reading = models.CharField(max_length=64)
+    count = models.BigIntegerField(default=0)
+    min = models.FloatField(blank=True, null=True)
+    max = models.FloatField(blank=True, null=True)
+    percentiles = ArrayField(
+        models.FloatField(),
+        blank=True,
+        null=True,
+        help_text="Values at QUANTILES",
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["quality", "site", "reading"],
+                name="unique_reading_statistic",
+            ),
+        ]
+
+    @classmethod
+    def rebuild(cls, per_site=False):
+        """
+        Recompute the catalog with one scan per measurement table, covering
+        every float reading at once. Returns the number of rows stored.
+        """
+        tables = {
+            "lev15": SiteMeasurementsDaily15,
+            "lev20": SiteMeasurementsDaily20,
+        }
+        statistics = []
+        for quality, model in tables.items():
+            readings = [
+                field.column
+                for field in model._meta.get_fields()
+                if isinstance(field, models.FloatField)
+            ]
+            columns = []
+            for reading in readings:
+                valid = f"FILTER (WHERE {reading} <> -999)"
+                columns += [
+                    f"COUNT(*) {valid}",
+                    f"MIN({reading}) {valid}",
+                    f"MAX({reading}) {valid}",
+                    f"percentile_cont(%s::float8[]) WITHIN GROUP (ORDER BY {reading}) {valid}",
+                ]
+
+            groupings = [("''", "")]
+            if per_site:
+                groupings.append(("site_id", "GROUP BY site_id"))
+
+            table = connection.ops.quote_name(model._meta.db_table)
+            with connection.cursor() as cursor:
+                for site_column, group_by in groupings:
+                    cursor.execute(
+                        f"SELECT {site_column}, {', '.join(columns)} FROM {table} {group_by}",
+                        [cls.QUANTILES] * len(readings),
+                    )
+                    for row in cursor.fetchall():
+                        for index, reading in enumerate(readings):
+                            count, low, high, percentiles = row[1 + 4 * index: 5 + 4 * index]
+                            statistics.append(
+                                cls(
+                                    quality=quality,
+                                    site=row[0],
+                                    reading=reading,
+                                    count=count,
+                                    min=low,
+                                    max=high,
+                                    percentiles=percentiles,
+                                )
+                            )
+
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(statistics)
+        return len(statistics)
+
+
+class DownloadJob(models.Model):
+    # A download archive built by a background worker (see jobs.py); clients
+    # poll it by id and fetch the archive once status is "done"
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    params = models.JSONField(help_text="Download selection (archive.download_selection)")
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    files_total = models.PositiveIntegerField(default=0)
+    files_done = models.PositiveIntegerField(default=0)
+    bytes_written = models.BigIntegerField(default=0)
+    archive_key = models.CharField(max_length=64, blank=True, default="")
+    archive_path = models.CharField(max_length=512, blank=True, default="")
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    @property
+    def progress(self):
+        if self.status == self.DONE:
+            return 1.0
+        return self.files_done / self.files_total if self.files_total else 0.0
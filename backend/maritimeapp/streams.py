@@ -0,0 +1,30 @@
+import io
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    Write-only file object whose contents are handed out and dropped with
+    drain(), for streaming writers that expect a file. tell() keeps counting
+    across drains so Parquet offsets stay correct.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
@@ -1,3 +1,644 @@
-from django.test import TestCase
+import base64
+import datetime
+import io
+import json
+import math
+import os
+import shutil
+import tempfile
 
-# Create your tests here.
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.contrib.gis.geos import Point, Polygon
+from django.db.models import Q
+from django.http import JsonResponse, QueryDict
+from django.test import RequestFactory, SimpleTestCase
+
+from .archive import filter_file
+from .archive_cache import archive_response
+from .cache import normalize_params, query_key
+from .date_index import SegmentReader, build_index, date_segments, month_ranges
+from .ingest import (
+    DAILY_HEADER,
+    FLOAT_COLUMNS,
+    INT_COLUMNS,
+    MEASUREMENT_COLUMNS,
+    read_daily_file,
+    transform_frame,
+)
+from .line_filter import line_filter
+from .models import SiteExtent
+from .streams import ChunkSink
+from .views import (
+    COLUMNAR_SCHEMA,
+    STREAM_CHUNK_SIZE,
+    after_key,
+    columnar_writer,
+    decode_cursor,
+    encode_cursor,
+    grid_cell_size,
+    json_array_stream,
+    measurement_plan,
+    record_batch,
+    tile_bounds,
+)
+
+HEADER = (
+    b"AERONET Maritime Aerosol Network\r\n"
+    b"Version 3\r\n"
+    b"Site\r\n"
+    b"Daily averages\r\n"
+    b"Date(dd:mm:yyyy),Time(hh:mm:ss),Latitude,Longitude,AOD_500nm\r\n"
+)
+
+# Two runs of March, a month with no data (May), and a line with no date
+DATA = [
+    b"28:02:2020,10:00:00,10.5,-20.5,0.10\r\n",
+    b"01:03:2020,10:00:00,11.0,-21.0,0.11\r\n",
+    b"15:03:2020,10:00:00,12.0,-22.0,0.12\r\n",
+    b"31:03:2020,10:00:00,13.0,-23.0,0.13\r\n",
+    b"02:04:2020,10:00:00,14.0,-24.0,0.14\r\n",
+    b"30:04:2020,10:00:00,15.0,-25.0,0.15\r\n",
+    b"not a date,10:00:00,15.0,-25.0,0.15\r\n",
+    b"20:03:2020,10:00:00,16.0,-26.0,0.16\r\n",
+    b"01:06:2020,10:00:00,17.0,-27.0,0.17\r\n",
+    b"30:06:2020,10:00:00,18.0,-28.0,0.18\r\n",
+]
+
+NO_BOUNDS = {"min_lat": None, "min_lng": None, "max_lat": None, "max_lng": None}
+
+DATE_RANGES = [
+    ("2020-03-01", "2020-03-31"),
+    ("2020-03-15", "2020-04-02"),
+    ("2020-02-28", "2020-02-28"),
+    ("2020-03-02", "2020-06-15"),
+    ("2020-04-01", None),
+    (None, "2020-03-15"),
+    # Empty: inside the gap in May, and after all data
+    ("2020-05-01", "2020-05-31"),
+    ("2021-01-01", None),
+]
+
+
+class SourceFileMixin:
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "Site_daily.lev15")
+        with open(self.path, "wb") as f:
+            f.write(HEADER + b"".join(DATA))
+
+    def expected(self, start_date, end_date, bounds=None):
+        keep = line_filter(HEADER.splitlines()[-1], start_date, end_date, bounds)
+        return [line for line in DATA if keep(line)]
+
+    def filtered(self, start_date, end_date, bounds=NO_BOUNDS, index=None):
+        out = io.BytesIO()
+        matched = filter_file(self.path, start_date, end_date, bounds, out, index)
+        return matched, out.getvalue()
+
+
+class LineFilterTests(SimpleTestCase):
+    columns = HEADER.splitlines()[-1]
+
+    def test_no_filter_keeps_everything(self):
+        keep = line_filter(self.columns)
+        self.assertTrue(all(keep(line) for line in DATA))
+
+    def test_date_range_is_inclusive(self):
+        keep = line_filter(self.columns, "2020-03-01", "2020-03-31")
+        self.assertEqual(
+            [line[:10] for line in DATA if keep(line)],
+            [b"01:03:2020", b"15:03:2020", b"31:03:2020", b"20:03:2020"],
+        )
+
+    def test_bounds(self):
+        keep = line_filter(
+            self.columns, bounds={"min_lat": "12", "max_lat": "15", "max_lng": "-23.5"}
+        )
+        self.assertEqual(
+            [line[:10] for line in DATA if keep(line)],
+            [b"02:04:2020", b"30:04:2020", b"not a date"],
+        )
+
+    def test_unreadable_fields_are_dropped(self):
+        keep = line_filter(self.columns, "2020-01-01", bounds={"min_lat": "0"})
+        self.assertFalse(keep(b"not a date,10:00:00,15.0,-25.0,0.15\r\n"))
+        self.assertFalse(keep(b"01:03:2020,10:00:00,N/A,-21.0,0.11\r\n"))
+        self.assertFalse(keep(b"01:03:2020\r\n"))
+
+    def test_missing_column_raises(self):
+        with self.assertRaises(ValueError):
+            line_filter(b"Time(hh:mm:ss),Latitude,Longitude\r\n", "2020-01-01")
+
+
+class FilterFileTests(SourceFileMixin, SimpleTestCase):
+    def test_output_is_byte_exact_subset(self):
+        bounds = {"min_lat": "11", "min_lng": None, "max_lat": "17", "max_lng": None}
+        for start_date, end_date in DATE_RANGES:
+            with self.subTest(start_date=start_date, end_date=end_date):
+                expected = self.expected(start_date, end_date, bounds)
+                matched, output = self.filtered(start_date, end_date, bounds)
+                self.assertEqual(output, HEADER + b"".join(expected))
+                self.assertEqual(matched, bool(expected))
+
+    def test_index_matches_scan(self):
+        index = build_index(self.path)
+        for start_date, end_date in DATE_RANGES:
+            with self.subTest(start_date=start_date, end_date=end_date):
+                self.assertEqual(
+                    self.filtered(start_date, end_date, index=index),
+                    self.filtered(start_date, end_date),
+                )
+
+    def test_empty_range_writes_only_header(self):
+        self.assertEqual(
+            self.filtered("2020-05-01", "2020-05-31", index=build_index(self.path)),
+            (False, HEADER),
+        )
+
+
+class DateIndexTests(SourceFileMixin, SimpleTestCase):
+    def test_runs(self):
+        index = build_index(self.path)
+        self.assertEqual(index["header_end"], len(HEADER))
+        self.assertEqual(
+            [month for month, _, _ in index["runs"]],
+            ["2020-02", "2020-03", "2020-04", None, "2020-03", "2020-06"],
+        )
+        self.assertEqual(index["runs"][-1][2], os.path.getsize(self.path))
+
+    def test_no_date_column(self):
+        with open(self.path, "wb") as f:
+            f.write(HEADER.replace(b"Date(dd:mm:yyyy)", b"Day") + b"".join(DATA))
+        self.assertIsNone(build_index(self.path))
+
+    def test_boundary_months(self):
+        index = build_index(self.path)
+        ranges = month_ranges(index, "2020-03-15", "2020-06-15")
+        # March and June are checked line by line and April is copied whole. The
+        # undated line is skipped, and the adjacent second March run merges with June
+        self.assertEqual([boundary for _, _, boundary in ranges], [True, False, True])
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.path))
+        self.assertEqual(month_ranges(index, "2020-05-01", "2020-05-31"), [])
+
+    def test_segments_match_scan(self):
+        index = build_index(self.path)
+        for start_date, end_date in DATE_RANGES:
+            with self.subTest(start_date=start_date, end_date=end_date):
+                keep = line_filter(HEADER.splitlines()[-1], start_date, end_date)
+                segments = date_segments(self.path, index, start_date, end_date, keep)
+                matched, output = self.filtered(start_date, end_date)
+                if not matched:
+                    self.assertIsNone(segments)
+                    continue
+                with SegmentReader(self.path, segments) as reader:
+                    self.assertEqual(reader.size, len(output))
+                    self.assertEqual(reader.read(), output)
+
+
+class SegmentReaderTests(SourceFileMixin, SimpleTestCase):
+    def test_reads_ranges_and_bytes_in_order(self):
+        segments = [(0, 5), b"-middle-", (len(HEADER), len(HEADER) + 10)]
+        expected = HEADER[:5] + b"-middle-" + DATA[0][:10]
+        for size in (1, 3, 7, 100, -1):
+            with self.subTest(size=size):
+                with SegmentReader(self.path, segments) as reader:
+                    self.assertEqual(reader.size, len(expected))
+                    chunks = []
+                    while True:
+                        chunk = reader.read(size)
+                        if not chunk:
+                            break
+                        self.assertLessEqual(len(chunk), size if size > 0 else len(expected))
+                        chunks.append(chunk)
+                    self.assertEqual(b"".join(chunks), expected)
+
+    def test_segments_are_not_consumed_by_size(self):
+        segments = [(0, 5)]
+        with SegmentReader(self.path, segments) as reader:
+            self.assertEqual(reader.read(2), HEADER[:2])
+            self.assertEqual(reader.read(), HEADER[2:5])
+            self.assertEqual(reader.read(), b"")
+        self.assertEqual(segments, [(0, 5)])
+
+
+class ArchiveRangeTests(SimpleTestCase):
+    content = bytes(range(256)) * 4
+    key = "0123abcd"
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, f"{self.key}.0123abcd_MAN_DATA.tar.gz")
+        with open(self.path, "wb") as f:
+            f.write(self.content)
+
+    def get(self, **headers):
+        request = RequestFactory().get("/download/", headers=headers)
+        response = archive_response(request, self.path, self.key)
+        self.addCleanup(response.close)
+        return response, b"".join(response)
+
+    def test_full(self):
+        response, body = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+        self.assertEqual(response["ETag"], f'"{self.key}"')
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertIn('filename="0123abcd_MAN_DATA.tar.gz"', response["Content-Disposition"])
+
+    def test_ranges(self):
+        size = len(self.content)
+        cases = {
+            "bytes=10-19": (10, 19),
+            "bytes=1000-": (1000, size - 1),
+            "bytes=-24": (size - 24, size - 1),
+            "bytes=-5000": (0, size - 1),
+            "bytes=1020-5000": (1020, size - 1),
+            " bytes=0-0 ": (0, 0),
+        }
+        for header, (start, end) in cases.items():
+            with self.subTest(range=header):
+                response, body = self.get(Range=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(body, self.content[start : end + 1])
+                self.assertEqual(response["Content-Range"], f"bytes {start}-{end}/{size}")
+                self.assertEqual(int(response["Content-Length"]), end - start + 1)
+
+    def test_unsatisfiable(self):
+        for header in ("bytes=1024-", "bytes=20-10"):
+            with self.subTest(range=header):
+                response, _ = self.get(Range=header)
+                self.assertEqual(response.status_code, 416)
+                self.assertEqual(response["Content-Range"], f"bytes */{len(self.content)}")
+
+    def test_unsupported_range_is_ignored(self):
+        for header in ("bytes=-", "bytes=0-1,5-6", "items=0-5"):
+            with self.subTest(range=header):
+                response, body = self.get(Range=header)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(body, self.content)
+
+    def test_if_range(self):
+        response, body = self.get(Range="bytes=0-9", **{"If-Range": f'"{self.key}"'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.content[:10])
+
+        response, body = self.get(Range="bytes=0-9", **{"If-Range": '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+
+
+class SiteExtentSearchBoxTests(SimpleTestCase):
+    def snap(self, point):
+        cell = SiteExtent.GRID_DEGREES
+        return Point(round(point.x / cell) * cell, round(point.y / cell) * cell)
+
+    def test_boxes_bracket_snapped_points(self):
+        bbox = Polygon.from_bbox((-10.0, 20.0, -9.0, 20.55))
+        outer, inner = SiteExtent.search_boxes(bbox)
+        for i in range(-30, 130):
+            for j in range(-30, 90):
+                point = Point(-10.0 + i * 0.0093, 20.0 + j * 0.0071)
+                snapped = self.snap(point)
+                if bbox.contains(point):
+                    self.assertTrue(outer.intersects(snapped), point)
+                if inner.contains(snapped):
+                    self.assertTrue(bbox.contains(point), point)
+
+    def test_small_bbox_has_no_inner_box(self):
+        outer, inner = SiteExtent.search_boxes(Polygon.from_bbox((0, 0, 0.05, 1)))
+        self.assertIsNone(inner)
+        self.assertEqual(outer.extent, (-0.05, -0.05, 0.1, 1.05))
+
+
+class CursorTests(SimpleTestCase):
+    def test_round_trip(self):
+        key = ("Ship", datetime.date(2020, 3, 1), datetime.time(10, 30, 5), 42)
+        self.assertEqual(decode_cursor(encode_cursor(*key)), key)
+
+    def test_invalid_cursors_raise(self):
+        def raw(value):
+            return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+        for cursor in (
+            "not base64!",
+            base64.urlsafe_b64encode(b"not json").decode(),
+            raw(["Ship", "2020-03-01", "10:30:00"]),
+            raw(["Ship", "2020-03-01", "25:99:00", 1]),
+            raw(["Ship", "2020-02-30", "10:30:00", 1]),
+            raw(["Ship", "yesterday", "10:30:00", 1]),
+            raw([None, "2020-03-01", "10:30:00", 1]),
+            raw(["Ship", "2020-03-01", "10:30:00", "x"]),
+        ):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises((ValueError, TypeError)):
+                    decode_cursor(cursor)
+
+    def test_after_key(self):
+        self.assertEqual(
+            after_key(("a", "b", "c"), (1, 2, 3)),
+            Q(a__gte=1) & (Q(a__gt=1) | Q(a=1, b__gt=2) | Q(a=1, b=2, c__gt=3)),
+        )
+
+
+class MeasurementPlanTests(SimpleTestCase):
+    def plan(self, query):
+        return measurement_plan(QueryDict(query))
+
+    def assertError(self, query, message):
+        plan = self.plan(query)
+        self.assertIsInstance(plan, JsonResponse)
+        self.assertEqual(plan.status_code, 400)
+        self.assertEqual(json.loads(plan.content), {"error": message})
+
+    def test_errors(self):
+        self.assertError("reading=aod_500nm", "No sites selected")
+        self.assertError("sites=Ship&reading=site", "Unknown reading")
+        self.assertError("sites=Ship&readings=aod_500nm,nope", "Unknown reading")
+        self.assertError("sites=Ship&readings=,", "Unknown reading")
+        self.assertError(
+            "sites=Ship&reading=aod_500nm&bin=day", "bin must be one of week, month, year"
+        )
+        self.assertError(
+            "sites=Ship&reading=aod_500nm&format=csv",
+            "format must be one of json, arrow, parquet",
+        )
+        for query in ("limit=0", "limit=x", "cursor=abc", "limit=5&cursor=bm90IGpzb24="):
+            with self.subTest(query=query):
+                self.assertError(f"sites=Ship&reading=aod_500nm&{query}", "Invalid limit or cursor")
+
+    def test_modes(self):
+        plan = self.plan("sites=Ship&reading=aod_500nm")
+        self.assertEqual((plan["stream"], plan["format"], plan["limit"]), (False, None, None))
+
+        plan = self.plan("sites=Ship&reading=aod_500nm&stream=1")
+        self.assertTrue(plan["stream"])
+
+        plan = self.plan("sites=Ship&reading=aod_500nm&format=parquet&stream=1")
+        self.assertEqual(plan["format"], "parquet")
+
+        plan = self.plan("sites=Ship&reading=aod_500nm&limit=100000")
+        self.assertEqual(plan["limit"], 5000)
+        self.assertFalse(plan["stream"])
+
+        cursor = encode_cursor("Ship", datetime.date(2020, 3, 1), datetime.time(10), 7)
+        plan = self.plan(f"sites=Ship&reading=aod_500nm&cursor={cursor}")
+        self.assertEqual(plan["limit"], 1000)
+
+        plan = self.plan("sites=Ship&reading=aod_500nm&bin=month&stream=1")
+        self.assertFalse(plan["stream"])
+        self.assertEqual(
+            plan["item"]({"site": "Ship", "period": "p", "mean": 1, "min": 0, "max": 2, "count": 3}),
+            {"site": "Ship", "date": "p", "mean": 1, "min": 0, "max": 2, "count": 3},
+        )
+
+    def test_readings(self):
+        # readings= takes precedence over reading=, and duplicates are dropped
+        plan = self.plan("sites=Ship&reading=bogus&readings=aod_500nm,water_vapor,aod_500nm")
+        row = ("Ship", "f", "2020-03-01", "10:00:00", 1.0, 2.0, 3, 0.1, None)
+        self.assertEqual(
+            plan["item"](row)["values"], {"aod_500nm": 0.1, "water_vapor": None}
+        )
+
+
+def daily_line(day="01:03:2020", lat="12.5", lng="-30.25", aod="0.123", observations="7"):
+    values = {column: "0.5" for column in DAILY_HEADER}
+    values.update(
+        {
+            "Date(dd:mm:yyyy)": day,
+            "Time(hh:mm:ss)": "10:00:00",
+            "Latitude": lat,
+            "Longitude": lng,
+            "AOD_500nm": aod,
+            "Number_of_Observations": observations,
+            "Last_Processing_Date(dd:mm:yyyy)": "05:04:2020",
+            "AERONET_Number": "42",
+            "Microtops_Number": "3",
+        }
+    )
+    return ",".join(values[column] for column in DAILY_HEADER) + "\n"
+
+
+def daily_file(lines):
+    header = "".join(f"disclaimer {n}\n" for n in range(4)) + ",".join(DAILY_HEADER) + "\n"
+    return (header + "".join(lines)).encode("latin-1")
+
+
+class TransformFrameTests(SimpleTestCase):
+    def transform(self, lines):
+        data = daily_file(lines)
+        (frame,) = read_daily_file(io.BytesIO(data), len(data))
+        return transform_frame(frame, "Ship", "Ship_daily.lev15")
+
+    def test_clean_rows(self):
+        batch = self.transform([daily_line(), daily_line(day="02:03:2020")])
+        self.assertEqual(list(batch.columns), MEASUREMENT_COLUMNS)
+        row = batch.iloc[0]
+        self.assertEqual(row["site_id"], "Ship")
+        self.assertEqual(row["filename"], "Ship_daily.lev15")
+        self.assertEqual(row["date"], datetime.datetime(2020, 3, 1))
+        self.assertEqual(row["last_processing_date"], datetime.datetime(2020, 4, 5))
+        self.assertEqual(row["time"], "10:00:00")
+        self.assertEqual(row["latlng"], "SRID=4326;POINT(-30.25 12.5)")
+        self.assertEqual(row["aod_500nm"], 0.123)
+        self.assertEqual(row["num_observations"], 7)
+        self.assertEqual(row["aeronet_number"], 42)
+
+    def test_blank_and_non_numeric_cells_are_filled(self):
+        batch = self.transform(
+            [
+                daily_line(aod="", observations=""),
+                daily_line(aod="N/A", observations="many"),
+                daily_line(aod="-999.", observations="2"),
+            ]
+        )
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(list(batch["aod_500nm"]), [-999.0, -999.0, -999.0])
+        self.assertEqual(list(batch["num_observations"]), [0, 0, 2])
+        # The NOT NULL columns never see NaN
+        numeric = list(FLOAT_COLUMNS.values()) + list(INT_COLUMNS.values())
+        self.assertFalse(batch[numeric].isna().any().any())
+
+    def test_bad_dates_and_coordinates_are_dropped(self):
+        batch = self.transform(
+            [
+                daily_line(day="31:02:2020"),
+                daily_line(day="bad"),
+                daily_line(lat=""),
+                daily_line(lng="east"),
+                daily_line(day="03:03:2020"),
+            ]
+        )
+        self.assertEqual(list(batch["date"]), [datetime.datetime(2020, 3, 3)])
+
+
+class ReadDailyFileTests(SimpleTestCase):
+    lines = [daily_line(day=f"{day:02d}:03:2020") for day in range(1, 31)]
+
+    def test_small_file_is_one_frame(self):
+        data = daily_file(self.lines)
+        frames = list(read_daily_file(io.BytesIO(data), len(data)))
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(len(frames[0]), 30)
+
+    def test_chunked_matches_single_pass(self):
+        data = daily_file(self.lines)
+        (whole,) = read_daily_file(io.BytesIO(data), len(data))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "Ship_daily.lev15")
+        with open(path, "wb") as f:
+            f.write(data)
+
+        line_bytes = len(self.lines[0])
+        for source in (io.BytesIO(data), path):
+            with self.subTest(source=type(source).__name__):
+                frames = list(
+                    read_daily_file(source, len(data), full_parse_threshold=0, chunk_bytes=4 * line_bytes)
+                )
+                self.assertGreater(len(frames), 1)
+                self.assertTrue(all(len(frame) <= 5 for frame in frames))
+                chunked = pd.concat(frames)
+                self.assertTrue(chunked.reset_index(drop=True).equals(whole))
+
+
+class JsonArrayStreamTests(SimpleTestCase):
+    def test_empty(self):
+        self.assertEqual("".join(json_array_stream(iter([]))), "[]")
+
+    def test_chunks_join_to_one_array(self):
+        items = [
+            {"n": n, "date": datetime.date(2020, 3, 1), "time": datetime.time(10, n % 60)}
+            for n in range(2 * STREAM_CHUNK_SIZE + 3)
+        ]
+        chunks = list(json_array_stream(iter(items)))
+        # Opening bracket, two full chunks, then the rest with the closing bracket
+        self.assertEqual(len(chunks), 4)
+        decoded = json.loads("".join(chunks))
+        self.assertEqual(len(decoded), len(items))
+        self.assertEqual(decoded[61], {"n": 61, "date": "2020-03-01", "time": "10:01:00"})
+
+
+class GridCellSizeTests(SimpleTestCase):
+    def test_zoom(self):
+        # Eight cells per 256px tile: 45 degrees at zoom 0, halving per level
+        self.assertEqual(grid_cell_size(QueryDict("")), 45.0)
+        self.assertEqual(grid_cell_size(QueryDict("zoom=3")), 45.0 / 8)
+
+    def test_cell_size_wins_and_is_clamped(self):
+        self.assertEqual(grid_cell_size(QueryDict("zoom=3&cell_size=2.5")), 2.5)
+        self.assertEqual(grid_cell_size(QueryDict("cell_size=0")), 0.001)
+        self.assertEqual(grid_cell_size(QueryDict("zoom=30")), 0.001)
+
+    def test_invalid(self):
+        for query in ("zoom=x", "cell_size=big"):
+            with self.subTest(query=query):
+                with self.assertRaises(ValueError):
+                    grid_cell_size(QueryDict(query))
+
+
+class TileBoundsTests(SimpleTestCase):
+    # Latitude limit of the web mercator projection
+    MAX_LAT = math.degrees(math.atan(math.sinh(math.pi)))
+
+    def assertExtent(self, polygon, expected):
+        for value, wanted in zip(polygon.extent, expected):
+            self.assertAlmostEqual(value, wanted, places=9)
+
+    def test_world_tile(self):
+        self.assertExtent(tile_bounds(0, 0, 0), (-180, -self.MAX_LAT, 180, self.MAX_LAT))
+
+    def test_quadrants(self):
+        self.assertExtent(tile_bounds(1, 0, 0), (-180, 0, 0, self.MAX_LAT))
+        self.assertExtent(tile_bounds(1, 1, 1), (0, -self.MAX_LAT, 180, 0))
+
+    def test_neighbours_share_edges(self):
+        z, x, y = 7, 40, 51
+        tile = tile_bounds(z, x, y).extent
+        self.assertAlmostEqual(tile_bounds(z, x + 1, y).extent[0], tile[2])
+        self.assertAlmostEqual(tile_bounds(z, x, y + 1).extent[3], tile[1])
+
+
+class QueryKeyTests(SimpleTestCase):
+    def test_sites_sorted_and_deduplicated(self):
+        params = QueryDict("sites=Ship_b,Ship_a,,Ship_b&reading=aod_500nm")
+        normalized = normalize_params(params)
+        self.assertEqual(normalized["sites"], "Ship_a,Ship_b")
+        self.assertEqual(normalized["reading"], "aod_500nm")
+        # The request's own QueryDict is left alone
+        self.assertEqual(params["sites"], "Ship_b,Ship_a,,Ship_b")
+
+    def test_bbox_snapped_outward(self):
+        normalized = normalize_params(
+            QueryDict("min_lat=10.123&min_lng=-20.001&max_lat=10.5&max_lng=-19.9999")
+        )
+        self.assertEqual(
+            [normalized[key] for key in ("min_lat", "min_lng", "max_lat", "max_lng")],
+            ["10.120000", "-20.010000", "10.500000", "-19.990000"],
+        )
+
+    def test_bad_coordinates_left_as_is(self):
+        self.assertEqual(normalize_params(QueryDict("min_lat=north"))["min_lat"], "north")
+
+    def test_small_pans_share_a_key(self):
+        a = normalize_params(QueryDict("sites=B,A&min_lat=10.121&max_lat=10.489&reading=x"))
+        b = normalize_params(QueryDict("reading=x&max_lat=10.481&min_lat=10.129&sites=A,B"))
+        self.assertEqual(query_key("view", a), query_key("view", b))
+
+    def test_key_depends_on_view_args_and_values(self):
+        params = QueryDict("sites=A&reading=aod_500nm")
+        key = query_key("site_measurements", params)
+        self.assertTrue(key.startswith("query:site_measurements:"))
+        self.assertNotEqual(key, query_key("list_sites", params))
+        self.assertNotEqual(key, query_key("site_measurements", params, 3))
+        self.assertNotEqual(
+            key, query_key("site_measurements", QueryDict("sites=A&reading=aod_440nm"))
+        )
+        self.assertNotEqual(
+            query_key("view", QueryDict("sites[]=A&sites[]=B")),
+            query_key("view", QueryDict("sites[]=A")),
+        )
+
+
+class ColumnarTests(SimpleTestCase):
+    # point_rows(queryset, reading) rows: site, filename, date, time, lng, lat,
+    # aeronet_number, value
+    rows = [
+        ("Ship", "f15", datetime.date(2020, 3, 1), datetime.time(10), -30.25, 12.5, 42, 0.123),
+        ("Ship", "f15", datetime.date(2020, 3, 2), datetime.time(11, 30, 5), None, None, 42, 0.2),
+        ("Boat", "f20", datetime.date(2021, 1, 9), datetime.time(0), 1.0, -2.0, 7, 1.5),
+    ]
+
+    def test_record_batch(self):
+        batch = record_batch(self.rows)
+        self.assertEqual(batch.schema, COLUMNAR_SCHEMA)
+        self.assertEqual(batch.num_rows, 3)
+        self.assertEqual([tuple(row.values()) for row in batch.to_pylist()], self.rows)
+
+    def write(self, output_format):
+        sink = ChunkSink()
+        writer = columnar_writer(sink, output_format)
+        chunks = []
+        for chunk in (self.rows[:2], self.rows[2:]):
+            writer.write_batch(record_batch(chunk))
+            chunks.append(sink.drain())
+        writer.close()
+        chunks.append(sink.drain())
+        return b"".join(chunks)
+
+    def test_arrow_stream(self):
+        table = pa.ipc.open_stream(self.write("arrow")).read_all()
+        self.assertEqual(table.schema, COLUMNAR_SCHEMA)
+        self.assertEqual([tuple(row.values()) for row in table.to_pylist()], self.rows)
+
+    def test_parquet(self):
+        parquet = pq.ParquetFile(io.BytesIO(self.write("parquet")))
+        # One row group per written batch
+        self.assertEqual(parquet.num_row_groups, 2)
+        table = parquet.read()
+        self.assertEqual(table.schema.names, COLUMNAR_SCHEMA.names)
+        self.assertEqual([tuple(row.values()) for row in table.to_pylist()], self.rows)
@@ -1,11 +1,20 @@
+from django.conf import settings
 from django.urls import path, include
 # from . import views
-from .views import download_data, list_sites, site_measurements, get_display_info
+from .views import download_data, create_download_job, download_job, download_job_archive, list_sites, site_measurements, get_display_info, measurement_grid, measurement_tile
+
+if settings.ASYNC_VIEWS:
+    from .async_views import list_sites, site_measurements, get_display_info
 
 urlpatterns = \
 [
     path('download/', download_data, name='download_data'),
+    path('download/jobs/', create_download_job, name='create_download_job'),
+    path('download/jobs/<uuid:job_id>/', download_job, name='download_job'),
+    path('download/jobs/<uuid:job_id>/archive/', download_job_archive, name='download_job_archive'),
     path('measurements/sites/', list_sites, name='list_sites'),
     path('measurements/', site_measurements, name='site_measurements'),
+    path('measurements/grid/', measurement_grid, name='measurement_grid'),
+    path('tiles/<int:z>/<int:x>/<int:y>.pbf', measurement_tile, name='measurement_tile'),
     path('display_info/', get_display_info, name='display_info')
 ]
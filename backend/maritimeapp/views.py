@@ -11,341 +11,100 @@ The user selects sites, start date, end date, retrievals, frequency, quality, an
 The backend filters the files based on the user's selection - a list of files names are generated based on parameters
 and  this list is used to processes the files to filter by date and bounds.
 
-The processed files are then zipped and sent to the user as a stream to be downloaded.
+The processed files are then zipped and sent to the user as a stream to be downloaded
+(see archive.py).
 """
 
+import json
 import os
-import shutil
-import subprocess
-import tarfile
-import time
-from concurrent.futures import ProcessPoolExecutor
-from datetime import date, datetime
-from re import sub
-
-import pandas as pd
-from django.http import HttpResponse
-from django.views.decorators.http import require_GET
-
-# from tqdm import tqdm
-
-
-def process_file(file_path, start_date, end_date, bounds):
-    try:
-        # First four lines contain disclaimers and metadata
-        with open(file_path, "r", encoding="latin-1") as f:
-            header_lines = [next(f) for _ in range(4)]
-
-        f.close()
-        # Row 5 is the header and the data starts from row 6
-        df = pd.read_csv(
-            file_path, skiprows=4, encoding="latin-1"
-        )  # Skip first 4 lines
 
-        date_format = "%d:%m:%Y"  # Key Date(dd:mm:yyyy)
+from django.http import JsonResponse, QueryDict, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
 
-        # Convert 'Date(dd:mm:yyyy)' column to datetime format from front end
-        df["Date(dd:mm:yyyy)"] = pd.to_datetime(
-            df["Date(dd:mm:yyyy)"], format=date_format, errors="coerce"
-        )
-
-        # Date rows that could not be parsed - TODO: Include in log file.
-        if df["Date(dd:mm:yyyy)"].isna().any():
-            print(f"Warning: Some dates in {file_path} could not be parsed")
-
-        # Convert to front end format for  filtering
-        start_date = (
-            pd.to_datetime(start_date, format="%Y-%m-%d", errors="coerce")
-            if start_date
-            else None
-        )
-        end_date = (
-            pd.to_datetime(end_date, format="%Y-%m-%d", errors="coerce")
-            if end_date
-            else None
-        )
-
-        # Filter by set date
-        if start_date:
-            df = df[df["Date(dd:mm:yyyy)"] >= start_date]
-        if end_date:
-            df = df[df["Date(dd:mm:yyyy)"] <= end_date]
-
-        # Filter by set boundaries
-        if bounds["min_lat"]:
-            df = df[df["Latitude"] >= float(bounds["min_lat"])]
-        if bounds["max_lat"]:
-            df = df[df["Latitude"] <= float(bounds["max_lat"])]
-        if bounds["min_lng"]:
-            df = df[df["Longitude"] >= float(bounds["min_lng"])]
-        if bounds["max_lng"]:
-            df = df[df["Longitude"] <= float(bounds["max_lng"])]
-
-        if df.empty:
-            return
-
-        # Convert dates back to original format from file
-        df["Date(dd:mm:yyyy)"] = df["Date(dd:mm:yyyy)"].dt.strftime(date_format)
-
-        # Overwrite the file with new filtered data
-        with open(file_path, "w") as f:
-            f.writelines(header_lines)
-            # new filtered data
-            df.to_csv(f, index=False, header=True)
-        f.close()
-
-    # TODO: Log exceptions to log file
-    except Exception as e:
-        print(f"Error processing file {file_path}: {e}")
+from . import jobs
+from .archive import archive_folder, archive_stream, download_selection
+from .archive_cache import archive_key, archive_response, cached_archive, store_archive
+from .models import DownloadJob
 
 
 @require_GET
 def download_data(request):
-    # Variables for file generation
-    src_dir = r"./src"  # Path to the source directory
-    temp_base_dir = r"./temp"  # Path to the temporary directory
-    unique_temp_folder = str(int(time.time())) + "_MAN_DATA"
-    keep_files = ["data_usage_policy.pdf", "data_usage_policy.txt"]
-
-    # Variables from request
-    sites = request.GET.getlist("sites[]")
-    start_date = request.GET.get("start_date", None)
-    end_date = request.GET.get("end_date", None)
-    retrievals = request.GET.getlist("retrievals[]")
-    frequency = request.GET.getlist("frequency[]")
-    quality = request.GET.getlist("quality[]")
-    bounds = {
-        "min_lat": request.GET.get("min_lat", None),
-        "min_lng": request.GET.get("min_lng", None),
-        "max_lat": request.GET.get("max_lat", None),
-        "max_lng": request.GET.get("max_lng", None),
-    }
-
-    print(f"{datetime(2004,10,16).strftime('%Y-%m-%d')}\n")
-    print(f"{start_date}\n")
-
-    if (start_date is not None) or (end_date is not None):
-        # Define the specific date to compare with
-        init_start_date = datetime(2004, 10, 16).strftime("%Y-%m-%d")
-        today_date = datetime.now().date().strftime("%Y-%m-%d")
-
-        if start_date is not None:
-            if start_date == init_start_date:
-                start_date = None
-        if end_date is not None:
-            if end_date == today_date:
-                end_date = None
-
-    # DEBUG
-    # print("Sites:", sites)
-    # print("Start Date:", start_date)
-    # print("End Date:", end_date)
-    # print("Retrievals:", retrievals)
-    # print("Frequency:", frequency)
-    # print("Quality:", quality)
-
-    # Create the unique temp directory
-    full_temp_path = os.path.join(temp_base_dir, unique_temp_folder)
-    os.makedirs(full_temp_path, exist_ok=True)
-
-    # Define file endings and options
-    file_endings = [
-        "all_points.lev10",
-        "all_points.lev15",
-        "all_points.lev20",
-        "series.lev15",
-        "series.lev20",
-        "daily.lev15",
-        "daily.lev20",
-        "all_points.ONEILL_10",
-        "all_points.ONEILL_15",
-        "all_points.ONEILL_20",
-        "series.ONEILL_15",
-        "series.ONEILL_20",
-        "daily.ONEILL_15",
-        "daily.ONEILL_20",
-    ]
-
-    def get_files_to_copy(sites, retrievals, frequency, quality, file_endings):
-        quality_map = {
-            "AOD": {
-                "Level 1.0": "lev10",
-                "Level 1.5": "lev15",
-                "Level 2.0": "lev20",
-            },
-            "SDA": {
-                "Level 1.0": "ONEILL_10",
-                "Level 1.5": "ONEILL_15",
-                "Level 2.0": "ONEILL_20",
-            },
-        }
-
-        files_to_copy = []
-        for retrieval in retrievals:
-            # TODO: Log to log file
-            if retrieval not in quality_map:
-                print(f"Warning: Retrieval '{retrieval}' not in quality map")
-                continue
-
-            for site in sites:
-                for freq in frequency:
-                    for q in quality:
-                        if freq == "Series":
-                            prefix = "series"
-                        elif freq == "Point":
-                            prefix = "all_points"
-                        elif freq == "Daily":
-                            prefix = "daily"
-                        else:
-                            continue
-
-                        # Generate files to download based on the quality map
-                        file_ending = quality_map[retrieval].get(q)
-                        if file_ending:
-                            file_name = f"{site}_{prefix}.{file_ending}"
-                            file_ending_only = f"{prefix}.{file_ending}"
-
-                            if file_ending_only in file_endings:
-                                files_to_copy.append(file_name)
-                            else:
-                                pass
-
-        return files_to_copy
-
-    def copy_files(src_dir, temp_dir, retrievals, files_to_copy):
-        complete_files = []
-        for retrieval in retrievals:
-            retrieval_dir = os.path.join(temp_dir, retrieval)
-            os.makedirs(retrieval_dir, exist_ok=True)
-
-            for file_name in files_to_copy:
-                src_file = os.path.join(src_dir, retrieval, file_name)
-                temp_file = os.path.join(retrieval_dir, file_name)
-
-                if os.path.isfile(src_file):
-                    complete_files.append(src_file)
-                    # shutil.copy(src_file, temp_file)
-                    # # TODO: Log to log file
-                    # print(f"Copied {src_file} to {temp_file}")
-                else:
-                    # TODO: Log to log file
-                    pass
-                # print(f"Source file {src_file} does not exist")
-
-        print(f"copying files {complete_files}")
-
-        # -Bulk copy all files to directory.
-        subprocess.run(["cp -r"] + complete_files + [temp_dir])
-        if "AOD" in retrievals:
-            subprocess.run(
-                f"mv {temp_dir}/*.lev* {os.path.join(temp_dir, 'AOD')}",
-                check=True,
-                shell=True,
-            )
-        if "SDA" in retrievals:
-            subprocess.run(
-                f"mv {temp_dir}/*.ONEILL* {os.path.join(temp_dir, 'SDA')}",
-                check=True,
-                shell=True,
-            )
-
-        for policy_file in keep_files:
-            src_policy_file = os.path.join(src_dir, policy_file)
-            temp_policy_file = os.path.join(temp_dir, policy_file)
-
-            os.makedirs(os.path.dirname(temp_policy_file), exist_ok=True)
-
-            if os.path.isfile(src_policy_file):
-                shutil.copy(src_policy_file, temp_policy_file)
-
-                # TODO: Log to log file
-                print(f"Copied {src_policy_file} to {temp_policy_file}")
-            else:
-                # TODO: Log to log file
-                print(f"Source policy file {src_policy_file} does not exist")
+    selection = download_selection(request.GET)
+    key = archive_key(selection)
+
+    # Identical selections over unchanged source files share one stored archive
+    path = cached_archive(key)
+    if path:
+        return archive_response(request, path, key)
+
+    # Files are read from ./src and filtered while the tar.gz is streamed out
+    folder = archive_folder(key)
+    response = StreamingHttpResponse(
+        store_archive(archive_stream(selection, folder), key, folder),
+        content_type="application/gzip",
+    )
+    response["Content-Disposition"] = f'attachment; filename="{folder}.tar.gz"'
+    response["ETag"] = f'"{key}"'
+    return response
 
-    def process_files(temp_dir, start_date, end_date, bounds, retrievals):
-        skip_files = {"data_usage_policy.pdf", "data_usage_policy.txt"}
 
-        files = []
-        for retrieval in retrievals:
-            subdir_path = os.path.join(temp_dir, retrieval)
-            print(f"Subdirectory path: {subdir_path}")
+def job_status(job):
+    status = {
+        "id": str(job.id),
+        "status": job.status,
+        "progress": job.progress,
+        "files_done": job.files_done,
+        "files_total": job.files_total,
+        "bytes": job.bytes_written,
+        "error": job.error or None,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at,
+        "status_url": reverse("download_job", args=[job.id]),
+    }
+    if job.status == DownloadJob.DONE:
+        status["archive_url"] = reverse("download_job_archive", args=[job.id])
+    return status
 
-            if os.path.isdir(subdir_path):
-                for file_name in os.listdir(subdir_path):
-                    if file_name not in skip_files:
-                        files.append(os.path.join(subdir_path, file_name))
-            else:
-                # TODO: Log to log file
-                print(
-                    f"Subdirectory {subdir_path} does not exist or is not a directory"
-                )
 
-        # Multiprocessing implementation
-        with ProcessPoolExecutor(max_workers=4) as executor:
-            futures = []
-            for file_path in files:
-                futures.append(
-                    executor.submit(
-                        process_file, file_path, start_date, end_date, bounds
-                    )
-                )
+def job_params(request):
+    # download_data's parameters as a JSON object, form fields or query string
+    if request.content_type == "application/json":
+        params = QueryDict(mutable=True)
+        for key, value in json.loads(request.body or b"{}").items():
+            params.setlist(key, value if isinstance(value, list) else [value])
+        return params
+    return request.POST or request.GET
 
-            for future in futures:
-                future.result()
 
-    # def add_with_progress(tarf, folder):
-    #     items = [item for item in os.listdir(folder) if os.path.exists(os.path.join(folder, item))]
-    #
-    #     print(items)
-    #     with tqdm(total=len(items), unit='file') as pbar:
-    #         for file in items:
-    #             tarf.add(os.path.join(folder, file), arcname=file)
-    #             pbar.update(1)  # Update progress bar for each file added
+@csrf_exempt
+@require_POST
+def create_download_job(request):
+    try:
+        selection = download_selection(job_params(request))
+    except (ValueError, AttributeError):
+        return JsonResponse({"error": "Invalid job parameters"}, status=400)
+    job = jobs.submit(selection)
+    return JsonResponse(job_status(job), status=202)
 
-    files_to_copy = get_files_to_copy(
-        sites, retrievals, frequency, quality, file_endings
-    )
-    copy_files(src_dir, full_temp_path, retrievals, files_to_copy)
 
-    if start_date is not None or end_date is not None or bounds["min_lat"] is not None:
-        process_files(full_temp_path, start_date, end_date, bounds, retrievals)
+@require_GET
+def download_job(request, job_id):
+    job = jobs.expire_stale(get_object_or_404(DownloadJob, pk=job_id))
+    return JsonResponse(job_status(job))
 
-    tar_filename = f"{unique_temp_folder}.tar.gz"
-    tar_path = os.path.join(temp_base_dir, tar_filename)
-    directory_to_archive = os.path.join(temp_base_dir, unique_temp_folder)
 
-    # Create a tar.gz file
-    try:
-        subprocess.run(["tar", "-czvf", tar_path, directory_to_archive], check=True)
-        print(f"Successfully created {tar_filename} from {directory_to_archive}")
-    except subprocess.CalledProcessError as e:
-        print(f"An error occurred while creating the tar file: {e}")
-        # for root, dirs, files in os.walk(full_temp_path):
-        #     for file in files:
-        #         file_path = os.path.join(root, file)
-        #         arcname = os.path.relpath(file_path, full_temp_path)
-        #         tarf.add(file_path, arcname=arcname)
-        #
-    response = HttpResponse(content_type="application/gzip")
-    response["Content-Disposition"] = f"attachment; filename={tar_filename}"
-
-    with open(tar_path, "rb") as f:
-        response.write(f.read())
-
-    # Clean up temporary files
-    try:
-        if os.path.exists(full_temp_path):
-            shutil.rmtree(full_temp_path)
-            print(f"Deleted temporary directory {full_temp_path}")
-        if os.path.exists(tar_path):
-            os.remove(tar_path)
-            print(f"Deleted temporary files {full_temp_path} and {tar_path}")
-    except Exception as e:
-        print(f"Error cleaning up temporary files: {e}")
-
-    return response
+@require_GET
+def download_job_archive(request, job_id):
+    job = get_object_or_404(DownloadJob, pk=job_id)
+    if job.status != DownloadJob.DONE:
+        return JsonResponse({"error": "Archive is not ready", "status": job.status}, status=409)
+    if not os.path.exists(job.archive_path):
+        # Evicted from the archive cache since the job finished
+        return JsonResponse({"error": "Archive has expired; please submit the job again"}, status=410)
+    return archive_response(request, job.archive_path, job.archive_key)
 
 
 from django.contrib.gis.geos import Point, Polygon
@@ -356,18 +115,83 @@ from django.utils.dateparse import parse_date
 from django.utils.timezone import now
 from django.views.decorators.http import require_GET
 
-from .models import Site, SiteMeasurementsDaily15
+from .cache import cached_query, conditional_query
+from .models import Site, SiteExtent, SiteMeasurementsDaily15
+
+
+def sites_in_bbox(bbox):
+    """
+    Names of sites with a measurement inside bbox. Sites whose extent lies
+    wholly inside are accepted from SiteExtent alone; only those straddling the
+    bbox edge are checked against the measurement table.
+    """
+    outer, inner = SiteExtent.search_boxes(bbox)
+    candidates = SiteExtent.objects.filter(extent__intersects=outer)
+    inside = set()
+    if inner is not None:
+        inside.update(
+            candidates.filter(extent__coveredby=inner).values_list("site_id", flat=True)
+        )
+    borderline = list(
+        candidates.exclude(site_id__in=inside).values_list("site_id", flat=True)
+    )
+    if borderline:
+        inside.update(
+            SiteMeasurementsDaily15.objects.filter(
+                site_id__in=borderline, latlng__within=bbox
+            )
+            .values_list("site_id", flat=True)
+            .distinct()
+        )
+    return inside
+
+
+def filter_site_dates(queryset, params):
+    """
+    Narrow a Site queryset to sites whose span_date overlaps the start_date /
+    end_date in params.
+    """
+    start_date_str = params.get("start_date")
+    end_date_str = params.get("end_date")
+    today = now().date()
+
+    if start_date_str:
+        start_date = parse_date(start_date_str)
+        if start_date:
+            if end_date_str:
+                end_date = parse_date(end_date_str)
+                if end_date:
+                    # Filter for sites with span_date that intersects with [start_date, end_date]
+                    queryset = queryset.filter(
+                        Q(span_date__0__lte=end_date, span_date__1__gte=start_date)
+                        | Q(span_date__0__lte=start_date, span_date__1__gte=end_date)
+                    ).distinct()
+            else:
+                # span_date [0, 1] 0 = start_date, 1 = end_date
+                # Filter for sites with span_date that intersects with [today, start_date]
+                queryset = queryset.filter(
+                    Q(span_date__0__lte=today, span_date__1__gte=start_date)
+                    | Q(span_date__0__lte=start_date, span_date__1__gte=today)
+                ).distinct()
+    elif end_date_str:
+        end_date = parse_date(end_date_str)
+        if end_date:
+            queryset = queryset.filter(
+                Q(span_date__0__lte=end_date, span_date__1__gte=end_date)
+            ).distinct()
+
+    return queryset
 
 
 @require_GET
+@conditional_query
+@cached_query
 def list_sites(request):
     reading = request.GET.get("reading")
     min_lat = request.GET.get("min_lat")
     min_lng = request.GET.get("min_lng")
     max_lat = request.GET.get("max_lat")
     max_lng = request.GET.get("max_lng")
-    start_date_str = request.GET.get("start_date")
-    end_date_str = request.GET.get("end_date")
 
     queryset = Site.objects.all()
 
@@ -380,11 +204,15 @@ def list_sites(request):
             )
 
             # Get all Site IDs that have measurements within the bounding box
-            filtered_sites_ids = (
-                SiteMeasurementsDaily15.objects.filter(latlng__within=bbox_polygon)
-                .values_list("site_id", flat=True)
-                .distinct()
-            )
+            if SiteExtent.objects.exists():
+                filtered_sites_ids = sites_in_bbox(bbox_polygon)
+            else:
+                # Extents not built yet (populate/update_dates has not run)
+                filtered_sites_ids = (
+                    SiteMeasurementsDaily15.objects.filter(latlng__within=bbox_polygon)
+                    .values_list("site_id", flat=True)
+                    .distinct()
+                )
 
             # Debug
             # print(f"list sites: {list(filtered_sites_ids)}")
@@ -399,32 +227,7 @@ def list_sites(request):
             print(f"Error with bounding box coordinates: {e}")
             return JsonResponse([], safe=False)
 
-    today = now().date()
-
-    if start_date_str:
-        start_date = parse_date(start_date_str)
-        if start_date:
-            if end_date_str:
-                end_date = parse_date(end_date_str)
-                if end_date:
-                    # Filter for sites with span_date that intersects with [start_date, end_date]
-                    queryset = queryset.filter(
-                        Q(span_date__0__lte=end_date, span_date__1__gte=start_date)
-                        | Q(span_date__0__lte=start_date, span_date__1__gte=end_date)
-                    ).distinct()
-            else:
-                # span_date [0, 1] 0 = start_date, 1 = end_date
-                # Filter for sites with span_date that intersects with [today, start_date]
-                queryset = queryset.filter(
-                    Q(span_date__0__lte=today, span_date__1__gte=start_date)
-                    | Q(span_date__0__lte=start_date, span_date__1__gte=today)
-                ).distinct()
-    elif end_date_str:
-        end_date = parse_date(end_date_str)
-        if end_date:
-            queryset = queryset.filter(
-                Q(span_date__0__lte=end_date, span_date__1__gte=end_date)
-            ).distinct()
+    queryset = filter_site_dates(queryset, request.GET)
 
     # Sorting based on start_date within span_date
     queryset = queryset.annotate(start_date=F("span_date__0")).order_by("start_date")
@@ -435,42 +238,120 @@ def list_sites(request):
 
 from django.db import models
 
-from .models import Site, SiteMeasurementsDaily15
+from .cache import dataset_version
+from .models import ReadingStatistic, Site, SiteMeasurementsDaily15
+
+# Display info built from the statistics catalog, rebuilt when the dataset version changes
+_display_info = {"version": None, "opts": [], "stats": {}}
+
+
+def refresh_display_info(version, statistics):
+    # Rebuild the in-memory display info from ReadingStatistic rows
+    stats = {}
+    for statistic in statistics:
+        summary = {
+            "count": statistic.count,
+            "min": statistic.min,
+            "max": statistic.max,
+            "percentiles": dict(
+                zip(
+                    (f"p{round(q * 100):02d}" for q in ReadingStatistic.QUANTILES),
+                    statistic.percentiles or [],
+                )
+            ),
+        }
+        stats.setdefault(statistic.site, {}).setdefault(statistic.quality, {})[
+            statistic.reading
+        ] = summary
+
+    _display_info["opts"] = [
+        field.name
+        for field in SiteMeasurementsDaily15._meta.get_fields()
+        if isinstance(field, models.FloatField)
+    ]
+    _display_info["stats"] = stats
+    _display_info["version"] = version
+    return _display_info
+
+
+def load_display_info():
+    version, _ = dataset_version()
+    if _display_info["version"] != version:
+        refresh_display_info(version, ReadingStatistic.objects.all())
+    return _display_info
 
 
 @require_GET
+@conditional_query
 def get_display_info(request):
-    returned = []
-    for field in SiteMeasurementsDaily15._meta.get_fields():
-        print(field)
-        if isinstance(field, models.FloatField):
-            returned.append(field.name)
-    return JsonResponse({"opts": returned})
+    # Served from memory; site= selects per-site statistics (populate --site-stats)
+    info = load_display_info()
+    site = request.GET.get("site", "")
+    return JsonResponse({"opts": info["opts"], "stats": info["stats"].get(site, {})})
 
 
+import base64
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
 from django.contrib.gis.geos import Polygon
 from django.contrib.gis.geos.point import Point
-from django.http import JsonResponse
-from django.utils.dateparse import parse_date
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Avg, Count, FloatField, Func, Max, Min, Q, Value
+from django.db.models.functions import NullIf, TruncMonth, TruncWeek, TruncYear
+from django.http import JsonResponse, StreamingHttpResponse
+from django.db import connection
+from django.utils.dateparse import parse_date, parse_time
 from django.views.decorators.http import require_GET
 
 from .models import Site, SiteMeasurementsDaily15
+from .streams import ChunkSink
 
+# Rows fetched per round trip from the server-side cursor when streaming
+STREAM_CHUNK_SIZE = 2000
 
-@require_GET
-def site_measurements(request):
-    aod_key = request.GET.get("reading")
-    min_lat = request.GET.get("min_lat")
-    min_lng = request.GET.get("min_lng")
-    max_lat = request.GET.get("max_lat")
-    max_lng = request.GET.get("max_lng")
-    start_date_str = request.GET.get("start_date")
-    end_date_str = request.GET.get("end_date")
-    selected_sites = request.GET.get("sites", "")
-    site_names = selected_sites.split(",") if selected_sites else []
+# limit= bounds for keyset-paginated site_measurements requests
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 5000
+
+# Rows per Arrow record batch / Parquet row group for format=arrow|parquet
+COLUMNAR_BATCH_SIZE = 50000
+
+COLUMNAR_FORMATS = {
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+# bin= values accepted by site_measurements, each compiled to date_trunc()
+TEMPORAL_BINS = {
+    "week": TruncWeek,
+    "month": TruncMonth,
+    "year": TruncYear,
+}
 
-    if len(site_names) == 0:
-        return JsonResponse({"error": "No sites selected"}, status=400)
+
+def reading_fields():
+    return [
+        field.name
+        for field in SiteMeasurementsDaily15._meta.get_fields()
+        if isinstance(field, models.FloatField)
+    ]
+
+
+def filter_measurements(params):
+    """
+    SiteMeasurementsDaily15 queryset for the sites, bbox and date range in
+    params, shared by the measurement endpoints.
+    """
+    min_lat = params.get("min_lat")
+    min_lng = params.get("min_lng")
+    max_lat = params.get("max_lat")
+    max_lng = params.get("max_lng")
+    start_date_str = params.get("start_date")
+    end_date_str = params.get("end_date")
+    selected_sites = params.get("sites", "")
+    site_names = selected_sites.split(",") if selected_sites else []
 
     sites = (
         Site.objects.filter(name__in=site_names) if site_names else Site.objects.all()
@@ -483,7 +364,9 @@ def site_measurements(request):
         polygon = Polygon.from_bbox(
             (float(min_lng), float(min_lat), float(max_lng), float(max_lat))
         )
-        queryset = queryset.filter(latlng__within=polygon).distinct()
+        # No .distinct(): rows are unique by id and nothing is joined, and DISTINCT
+        # would make PostgreSQL sort the whole result before the first row streams
+        queryset = queryset.filter(latlng__within=polygon)
 
     if start_date_str and end_date_str:
         start_date = parse_date(start_date_str)
@@ -496,24 +379,454 @@ def site_measurements(request):
         end_date = parse_date(end_date_str)
         queryset = queryset.filter(date__lte=end_date)
 
-    # Convert queryset to a list of dictionaries and handle latlng serialization
-    measurements = list(
-        queryset.exclude(**{aod_key: -999}).values(
-            "site", "filename", "date", "time", "latlng", "aeronet_number", aod_key
+    return queryset
+
+
+def point_rows(queryset, *columns):
+    # Common measurement columns with lng/lat taken from SQL, followed by columns
+    return queryset.annotate(
+        lng=Func("latlng", function="ST_X", output_field=FloatField()),
+        lat=Func("latlng", function="ST_Y", output_field=FloatField()),
+    ).values_list(
+        "site", "filename", "date", "time", "lng", "lat", "aeronet_number", *columns
+    )
+
+
+def measurement_item(row):
+    # point_rows(queryset, reading) row as a response dict; extra trailing columns
+    # (e.g. page_rows' id) are ignored
+    site, filename, day, moment, lng, lat, aeronet_number, value, *_ = row
+    return {
+        "site": site,
+        "filename": filename,
+        "date": day,
+        "time": moment,
+        "latlng": {"lng": lng, "lat": lat} if lng is not None else None,
+        "aeronet_number": aeronet_number,
+        "value": value,
+    }
+
+
+def multi_reading_item(row, readings):
+    # multi_reading_rows row as a response dict with every reading under "values"
+    site, filename, day, moment, lng, lat, aeronet_number, *values = row
+    return {
+        "site": site,
+        "filename": filename,
+        "date": day,
+        "time": moment,
+        "latlng": {"lng": lng, "lat": lat} if lng is not None else None,
+        "aeronet_number": aeronet_number,
+        "values": dict(zip(readings, values)),
+    }
+
+
+def aggregate_item(row):
+    # aggregate_rows row as a response dict
+    return {
+        "site": row["site"],
+        "date": row["period"],
+        "mean": row["mean"],
+        "min": row["min"],
+        "max": row["max"],
+        "count": row["count"],
+    }
+
+
+def json_array_stream(items):
+    # Serialize dicts as one JSON array, yielding a few thousand elements at a time
+    yield "["
+    separator = ""
+    buffer = []
+    for item in items:
+        buffer.append(separator + json.dumps(item, cls=DjangoJSONEncoder))
+        separator = ","
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            yield "".join(buffer)
+            buffer = []
+    buffer.append("]")
+    yield "".join(buffer)
+
+
+def multi_reading_rows(queryset, readings):
+    # Every requested reading per row from a single query. -999 is turned into
+    # NULL in SQL, and rows where all requested readings are missing are left out.
+    all_missing = Q()
+    for reading in readings:
+        all_missing &= Q(**{reading: -999})
+
+    nulled = {f"nulled_{reading}": NullIf(reading, Value(-999.0)) for reading in readings}
+    return point_rows(queryset.exclude(all_missing).annotate(**nulled), *nulled)
+
+
+def encode_cursor(site, day, moment, pk):
+    raw = json.dumps([site, day, moment, pk], cls=DjangoJSONEncoder)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Raises ValueError (or TypeError) for anything encode_cursor did not produce
+    site, day, moment, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    day, moment = parse_date(day), parse_time(moment)
+    if not isinstance(site, str) or day is None or moment is None:
+        raise ValueError("Invalid cursor")
+    return site, day, moment, int(pk)
+
+
+def after_key(columns, values):
+    # Row-value comparison (columns) > (values) as an OR of equal prefixes
+    # (a > x, or a = x and b > y, or ...). The leading a >= x lets the planner
+    # start the index scan at the cursor instead of filtering from the top.
+    condition = Q()
+    for position, (column, value) in enumerate(zip(columns, values)):
+        prefix = dict(zip(columns[:position], values))
+        condition |= Q(**prefix, **{f"{column}__gt": value})
+    return Q(**{f"{columns[0]}__gte": values[0]}) & condition
+
+
+def page_rows(queryset, aod_key, after, limit):
+    """
+    Up to limit + 1 rows ordered by (site_id, date, time, id) following the
+    decoded cursor after (or from the start); the extra row tells whether a
+    next page exists. Each page is an index range scan from the cursor,
+    regardless of how deep it is.
+    """
+    key = ("site_id", "date", "time", "id")
+    queryset = queryset.order_by(*key)
+    if after:
+        queryset = queryset.filter(after_key(key, after))
+    return point_rows(queryset, aod_key, "id")[: limit + 1]
+
+
+def page_response(rows, limit):
+    # One page from the fetched page_rows, with the cursor of its last row if
+    # another page follows
+    next_cursor = None
+    if len(rows) > limit:
+        site, _, day, moment, *_, pk = rows[limit - 1]
+        next_cursor = encode_cursor(site, day, moment, pk)
+    return JsonResponse(
+        {"results": [measurement_item(row) for row in rows[:limit]], "next": next_cursor}
+    )
+
+
+# Column layout of format=arrow|parquet, matching point_rows(queryset, reading)
+COLUMNAR_SCHEMA = pa.schema(
+    [
+        ("site", pa.string()),
+        ("filename", pa.string()),
+        ("date", pa.date32()),
+        ("time", pa.time64("us")),
+        ("lng", pa.float64()),
+        ("lat", pa.float64()),
+        ("aeronet_number", pa.int64()),
+        ("value", pa.float64()),
+    ]
+)
+
+
+def record_batch(chunk):
+    columns = list(zip(*chunk))
+    return pa.record_batch(
+        [
+            pa.array(column, type=field.type)
+            for column, field in zip(columns, COLUMNAR_SCHEMA)
+        ],
+        schema=COLUMNAR_SCHEMA,
+    )
+
+
+def columnar_writer(sink, output_format):
+    if output_format == "arrow":
+        return pa.ipc.new_stream(sink, COLUMNAR_SCHEMA)
+    return pq.ParquetWriter(sink, COLUMNAR_SCHEMA)
+
+
+def columnar_response(content, output_format):
+    content_type, extension = COLUMNAR_FORMATS[output_format]
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response["Content-Disposition"] = f"attachment; filename=measurements.{extension}"
+    return response
+
+
+def columnar_measurements(rows, output_format):
+    """
+    point_rows as an Arrow IPC stream or a Parquet file, one record batch
+    (row group) per COLUMNAR_BATCH_SIZE rows read from a server-side cursor.
+    lng/lat are plain float columns selected with ST_X/ST_Y.
+    """
+    rows = rows.iterator(chunk_size=STREAM_CHUNK_SIZE)
+
+    def generate():
+        sink = ChunkSink()
+        writer = columnar_writer(sink, output_format)
+
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= COLUMNAR_BATCH_SIZE:
+                writer.write_batch(record_batch(chunk))
+                chunk = []
+                yield sink.drain()
+        if chunk:
+            writer.write_batch(record_batch(chunk))
+        writer.close()
+        yield sink.drain()
+
+    return columnar_response(generate(), output_format)
+
+
+def aggregate_rows(queryset, aod_key, bin_size):
+    # Mean/min/max/count of the reading per site and date_trunc() bin, computed
+    # in the database. The caller has already excluded -999 values.
+    return (
+        queryset.annotate(period=TEMPORAL_BINS[bin_size]("date"))
+        .values("site", "period")
+        .annotate(
+            mean=Avg(aod_key),
+            min=Min(aod_key),
+            max=Max(aod_key),
+            count=Count("id"),
         )
+        .order_by("site", "period")
     )
 
-    # Convert latlng (Point) to a serializable format
-    for measurement in measurements:
-        latlng = measurement.get("latlng")
-        if isinstance(latlng, Point):
-            measurement["latlng"] = {"lng": latlng.x, "lat": latlng.y}
-        else:
-            measurement["latlng"] = (
-                None  # Handle cases where latlng is None or not a Point
-            )
 
-        # Rename the dynamic key to "value"
-        measurement["value"] = measurement.pop(aod_key)
+def measurement_plan(params):
+    """
+    Validate the site_measurements parameters and work out the rows to return,
+    for both the sync and the async view. Returns an error JsonResponse, or a
+    dict with:
+
+    rows    queryset of the rows to serialize
+    item    row -> response dict (for JSON output)
+    stream  stream the JSON array from a server-side cursor
+    format  "arrow" or "parquet" for columnar output, else None
+    limit   page size when the result is keyset paginated, else None
+    """
+    aod_key = params.get("reading")
+    selected_sites = params.get("sites", "")
+    site_names = selected_sites.split(",") if selected_sites else []
+
+    if len(site_names) == 0:
+        return JsonResponse({"error": "No sites selected"}, status=400)
+
+    plan = {
+        "item": measurement_item,
+        # stream=1 walks the result with a server-side cursor instead of building a list
+        "stream": bool(params.get("stream")),
+        "format": None,
+        "limit": None,
+    }
+
+    # readings=a,b,c returns every listed reading per row under "values"
+    readings_param = params.get("readings")
+    if readings_param:
+        readings = list(dict.fromkeys(filter(None, readings_param.split(","))))
+        if not readings or not set(readings) <= set(reading_fields()):
+            return JsonResponse({"error": "Unknown reading"}, status=400)
+        plan["rows"] = multi_reading_rows(filter_measurements(params), readings)
+        plan["item"] = lambda row: multi_reading_item(row, readings)
+        return plan
+
+    if aod_key not in reading_fields():
+        return JsonResponse({"error": "Unknown reading"}, status=400)
+
+    bin_size = params.get("bin")
+    if bin_size and bin_size not in TEMPORAL_BINS:
+        return JsonResponse({"error": "bin must be one of week, month, year"}, status=400)
+
+    queryset = filter_measurements(params).exclude(**{aod_key: -999})
+
+    if bin_size:
+        plan["rows"] = aggregate_rows(queryset, aod_key, bin_size)
+        plan["item"] = aggregate_item
+        plan["stream"] = False
+        return plan
+
+    output_format = params.get("format")
+    if output_format in COLUMNAR_FORMATS:
+        plan["rows"] = point_rows(queryset, aod_key)
+        plan["format"] = output_format
+        return plan
+    if output_format and output_format != "json":
+        return JsonResponse({"error": "format must be one of json, arrow, parquet"}, status=400)
+
+    # limit= / cursor= switch to keyset pagination
+    if params.get("limit") or params.get("cursor"):
+        try:
+            limit = min(int(params.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+            if limit < 1:
+                raise ValueError
+            after = decode_cursor(params["cursor"]) if params.get("cursor") else None
+        except (ValueError, TypeError, UnicodeDecodeError):
+            return JsonResponse({"error": "Invalid limit or cursor"}, status=400)
+        plan["rows"] = page_rows(queryset, aod_key, after, limit)
+        plan["limit"] = limit
+        plan["stream"] = False
+        return plan
+
+    plan["rows"] = point_rows(queryset, aod_key)
+    return plan
+
+
+@require_GET
+@conditional_query
+@cached_query
+def site_measurements(request):
+    plan = measurement_plan(request.GET)
+    if isinstance(plan, JsonResponse):
+        return plan
+
+    rows = plan["rows"]
+    if plan["format"]:
+        return columnar_measurements(rows, plan["format"])
+    if plan["limit"]:
+        return page_response(list(rows), plan["limit"])
+    if plan["stream"]:
+        # Memory use does not grow with the size of the result
+        items = map(plan["item"], rows.iterator(chunk_size=STREAM_CHUNK_SIZE))
+        return StreamingHttpResponse(json_array_stream(items), content_type="application/json")
+    return JsonResponse([plan["item"](row) for row in rows], safe=False)
+
+
+from django.contrib.gis.db.models import PointField
+from django.db.models import Value
+
+# Grid cells per 256px map tile when the cell size is derived from zoom= (32px cells)
+GRID_CELLS_PER_TILE = 8
+MIN_GRID_CELL_SIZE = 0.001
+
+
+def grid_cell_size(params):
+    # Explicit cell_size (degrees) wins over zoom
+    if params.get("cell_size"):
+        return max(float(params["cell_size"]), MIN_GRID_CELL_SIZE)
+    zoom = int(params.get("zoom", 0))
+    return max(360.0 / (2 ** zoom * GRID_CELLS_PER_TILE), MIN_GRID_CELL_SIZE)
+
 
-    return JsonResponse(measurements, safe=False)
+@require_GET
+@conditional_query
+@cached_query
+def measurement_grid(request):
+    """
+    Measurements clustered on a lng/lat grid with ST_SnapToGrid, one GeoJSON
+    feature per occupied cell, so the payload follows the viewport rather than
+    the number of rows.
+
+    Accepts the site_measurements filters plus zoom= or cell_size=.
+    """
+    aod_key = request.GET.get("reading")
+    if aod_key not in reading_fields():
+        return JsonResponse({"error": "Unknown reading"}, status=400)
+
+    try:
+        cell_size = grid_cell_size(request.GET)
+    except (ValueError, OverflowError):
+        return JsonResponse({"error": "Invalid zoom or cell_size"}, status=400)
+
+    cells = (
+        filter_measurements(request.GET)
+        .exclude(**{aod_key: -999})
+        .annotate(
+            cell=Func(
+                "latlng",
+                Value(cell_size),
+                function="ST_SnapToGrid",
+                output_field=PointField(),
+            ),
+        )
+        .values("cell")
+        .annotate(
+            count=Count("id"),
+            mean=Avg(aod_key),
+            center_lng=Avg(Func("latlng", function="ST_X", output_field=FloatField())),
+            center_lat=Avg(Func("latlng", function="ST_Y", output_field=FloatField())),
+        )
+        .order_by()
+    )
+
+    features = [
+        {
+            "type": "Feature",
+            # Placed at the mean position of the cell's points rather than the grid node
+            "geometry": {
+                "type": "Point",
+                "coordinates": [cell["center_lng"], cell["center_lat"]],
+            },
+            "properties": {"count": cell["count"], "mean": cell["mean"]},
+        }
+        for cell in cells
+    ]
+    return JsonResponse(
+        {"type": "FeatureCollection", "cell_size": cell_size, "features": features}
+    )
+
+
+import math
+
+from django.db import connection
+from django.http import HttpResponse
+
+
+def tile_bounds(z, x, y):
+    # lng/lat bounding box of a web mercator (XYZ) tile
+    n = 2**z
+    min_lng = x / n * 360.0 - 180.0
+    max_lng = (x + 1) / n * 360.0 - 180.0
+    max_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    min_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return Polygon.from_bbox((min_lng, min_lat, max_lng, max_lat))
+
+
+@require_GET
+@conditional_query
+@cached_query
+def measurement_tile(request, z, x, y):
+    """
+    Mapbox Vector Tile of the measurement points in tile z/x/y, built with
+    ST_AsMVT/ST_AsMVTGeom. Accepts the site_measurements filters.
+    """
+    aod_key = request.GET.get("reading")
+    if aod_key not in reading_fields():
+        return JsonResponse({"error": "Unknown reading"}, status=400)
+
+    if z > 24 or not (0 <= x < 2**z and 0 <= y < 2**z):
+        return JsonResponse({"error": "Invalid tile"}, status=400)
+
+    # The ORM only picks the ids; the MVT geometry is selected in raw SQL, since a
+    # GeometryField selected at the top level of an ORM query is cast to bytea
+    ids = (
+        filter_measurements(request.GET)
+        .exclude(**{aod_key: -999})
+        .filter(latlng__intersects=tile_bounds(z, x, y))
+        .values("id")
+    )
+    id_sql, id_params = ids.query.sql_with_params()
+
+    table = connection.ops.quote_name(SiteMeasurementsDaily15._meta.db_table)
+    value = connection.ops.quote_name(aod_key)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT ST_AsMVT(tile, 'measurements', 4096, 'geom') FROM (
+                SELECT
+                    ST_AsMVTGeom(
+                        ST_Transform(m.latlng, 3857), ST_TileEnvelope(%s, %s, %s)
+                    ) AS geom,
+                    m.site_id AS site,
+                    m.date::text AS day,
+                    m.aeronet_number,
+                    m.{value} AS value
+                FROM {table} AS m
+                WHERE m.id IN ({id_sql})
+            ) AS tile
+            """,
+            [z, x, y, *id_params],
+        )
+        tile = cursor.fetchone()[0]
+
+    return HttpResponse(
+        bytes(tile or b""), content_type="application/vnd.mapbox-vector-tile"
+    )